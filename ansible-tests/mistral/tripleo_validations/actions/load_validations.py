@@ -17,6 +17,17 @@ DEFAULT_METADATA = {
 
 VALIDATIONS_DIR = '/usr/share/tripleo-validations/validations'
 
+# Use the libyaml bindings when they're available, fall back to the pure
+# Python loader otherwise.
+try:
+    YamlLoader = yaml.CSafeLoader
+except AttributeError:
+    YamlLoader = yaml.SafeLoader
+
+
+def load_yaml(stream):
+    return yaml.load(stream, Loader=YamlLoader)
+
 
 def get_validation_metadata(validation, key):
     try:
@@ -33,7 +44,7 @@ def load_validations(groups=None):
     results = []
     for index, validation_path in enumerate(sorted(paths)):
         with open(validation_path) as f:
-            validation = yaml.safe_load(f.read())
+            validation = load_yaml(f.read())
             validation_groups = get_validation_metadata(validation, 'groups')
             if not groups or \
                     set.intersection(set(groups), set(validation_groups)):
@@ -1,11 +1,26 @@
 #!/usr/bin/env python
 
+import array
+import collections
+import fnmatch
 import json
 import os
+import re
+import signal
 import six
 import sys
+import tempfile
+import threading
+import time
+import yaml
+from multiprocessing.pool import ThreadPool
 from subprocess import Popen, PIPE
 
+try:
+    import swiftclient
+except ImportError:
+    swiftclient = None
+
 from ansible.module_utils.basic import *
 
 
@@ -17,25 +32,411 @@ author: "Swapnil Kulkarni, @coolsvap"
 '''
 
 
-def get_node_hardware_data(hw_id, upenv):
-    '''Read the inspector data about the given node from Swift'''
-    p = Popen(('swift', 'download', '--output', '-', 'ironic-inspector', hw_id),
-              env=upenv, stdout=PIPE, stderr=PIPE)
-    if p.wait() == 0:
-        return json.loads(p.stdout.read())
+INSPECTOR_CONTAINER = 'ironic-inspector'
+IGNORE = 'ignore'
+MUST_EQUAL = 'must_equal'
+MUST_UNIQUE = 'must_unique'
+# The first matching category wins
+RULES = (IGNORE, MUST_UNIQUE, MUST_EQUAL)
+PROFILE_MEMBERS_SHOWN = 5
+# Keys with at least this many distinct values per node are not profiled
+PROFILE_MAX_DISTINCT_RATIO = 0.5
+FETCH_THREADS = 16
+FETCH_TIMEOUT = 30
+FETCH_RETRIES = 3
+RETRY_DELAY = 1.0
+# Connection options of python-swiftclient and the variables the `swift`
+# command line client reads them from
+SWIFT_OS_OPTIONS = (
+    ('project_name', 'OS_PROJECT_NAME'),
+    ('project_id', 'OS_PROJECT_ID'),
+    ('tenant_id', 'OS_TENANT_ID'),
+    ('user_domain_name', 'OS_USER_DOMAIN_NAME'),
+    ('user_domain_id', 'OS_USER_DOMAIN_ID'),
+    ('project_domain_name', 'OS_PROJECT_DOMAIN_NAME'),
+    ('project_domain_id', 'OS_PROJECT_DOMAIN_ID'),
+    ('region_name', 'OS_REGION_NAME'),
+    ('endpoint_type', 'OS_ENDPOINT_TYPE'),
+    ('service_type', 'OS_SERVICE_TYPE'),
+)
+
+
+class ObjectStoreError(Exception):
+    pass
+
+
+class SwiftClientStore(object):
+    '''Read objects from Swift through python-swiftclient.
+
+    Swift connections must not be shared between threads, so every thread
+    opens its own one and keeps it for all the objects it downloads.
+    '''
+
+    def __init__(self, auth_url, username, password, tenant_name,
+                 timeout=FETCH_TIMEOUT, auth_version='2', os_options=None,
+                 cacert=None, insecure=False):
+        # The retries are done by get_node_hardware_data()
+        self.connection_args = dict(
+            authurl=auth_url, user=username, key=password,
+            tenant_name=tenant_name, auth_version=auth_version,
+            os_options=os_options or {}, cacert=cacert, insecure=insecure,
+            timeout=timeout, retries=0)
+        self.local = threading.local()
+
+    def connection(self):
+        if getattr(self.local, 'connection', None) is None:
+            self.local.connection = swiftclient.client.Connection(
+                **self.connection_args)
+        return self.local.connection
+
+    def request(self, method, *args, **kwargs):
+        try:
+            return getattr(self.connection(), method)(*args, **kwargs)
+        except Exception as e:
+            # Start over with a new connection after a timeout or an error
+            self.local.connection = None
+            raise ObjectStoreError(str(e))
+
+    def list_objects(self, container):
+        '''The names and ETags of the objects in the container.'''
+        _, objects = self.request('get_container', container,
+                                  full_listing=True)
+        return [(obj['name'], obj.get('hash')) for obj in objects]
+
+    def list(self, container):
+        return [name for name, _ in self.list_objects(container)]
+
+    def get(self, container, name):
+        _, body = self.request('get_object', container, name)
+        return body
+
+
+def kill_process_group(p):
+    try:
+        os.killpg(p.pid, signal.SIGKILL)
+    except OSError:
+        # It has just finished
+        pass
+
+
+class SwiftCommandStore(object):
+    '''Read objects from Swift with the `swift` command line client.'''
+
+    def __init__(self, env, timeout=FETCH_TIMEOUT):
+        self.env = env
+        self.timeout = timeout
+
+    def run(self, *args):
+        # In its own process group so that a timeout kills its children too.
+        # preexec_fn is not safe in the threads of the fetch pool, only
+        # Python 2 lacks start_new_session.
+        if six.PY2:
+            session = dict(preexec_fn=os.setsid)
+        else:
+            session = dict(start_new_session=True)
+        try:
+            p = Popen(('swift',) + args, env=self.env, stdout=PIPE,
+                      stderr=PIPE, **session)
+        except OSError as e:
+            raise ObjectStoreError("Error running `swift`: {}".format(e))
+        timer = None
+        if self.timeout:
+            timer = threading.Timer(self.timeout, kill_process_group, (p,))
+            timer.start()
+        try:
+            # Reading the output only after wait() would block forever once
+            # an object fills the pipe buffer
+            out, err = p.communicate()
+        finally:
+            if timer:
+                timer.cancel()
+        if p.returncode != 0:
+            msg = "Error running `swift {}`: {}".format(
+                ' '.join(args),
+                err.decode('utf-8', 'replace').strip() or 'timed out')
+            raise ObjectStoreError(msg)
+        return out
+
+    def list_objects(self, container):
+        # `swift list` does not show the ETags
+        return [(name, None) for name in self.list(container)]
+
+    def list(self, container):
+        out = self.run('list', container)
+        return [i.strip() for i in out.decode('utf-8').splitlines()
+                if i.strip()]
+
+    def get(self, container, name):
+        return self.run('download', '--output', '-', container, name)
+
+
+class CachedStore(object):
+    '''
+    Keep the objects of another store in a local directory.
+
+    The objects are stored by container, name and ETag. The ETags come from
+    the container listing, so a single listing tells which objects changed
+    and only those are downloaded again. Objects listed without an ETag are
+    always downloaded.
+    '''
+
+    def __init__(self, store, directory):
+        self.store = store
+        self.directory = directory
+        self.etags = {}
+
+    def container_dir(self, container):
+        return os.path.join(self.directory,
+                            six.moves.urllib.parse.quote(container, safe=''))
+
+    def file_name(self, name, etag):
+        return '{}.{}'.format(six.moves.urllib.parse.quote(name, safe=''),
+                              six.moves.urllib.parse.quote(etag, safe=''))
+
+    def list_objects(self, container):
+        objects = self.store.list_objects(container)
+        self.etags[container] = dict(objects)
+        self.prune(container, objects)
+        return objects
+
+    def list(self, container):
+        return [name for name, _ in self.list_objects(container)]
+
+    def prune(self, container, objects):
+        '''Remove the objects deleted or changed since they were cached.'''
+        current = set(self.file_name(name, etag)
+                      for name, etag in objects if etag)
+        try:
+            cached = os.listdir(self.container_dir(container))
+        except OSError:
+            return
+        for file_name in cached:
+            if file_name not in current:
+                try:
+                    os.remove(os.path.join(self.container_dir(container),
+                                           file_name))
+                except OSError:
+                    pass
+
+    def get(self, container, name):
+        etag = self.etags.get(container, {}).get(name)
+        if not etag:
+            return self.store.get(container, name)
+        path = os.path.join(self.container_dir(container),
+                            self.file_name(name, etag))
+        try:
+            with open(path, 'rb') as cache_file:
+                return cache_file.read()
+        except (IOError, OSError):
+            pass
+
+        blob = self.store.get(container, name)
+        if isinstance(blob, six.text_type):
+            blob = blob.encode('utf-8')
+
+        # Write to a temporary file first, concurrent runs never see partial
+        # files.
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+        except OSError:
+            # Created by another thread in the meantime
+            pass
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, 'wb') as cache_file:
+                cache_file.write(blob)
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            pass
+        return blob
+
+
+def create_store(env, timeout=FETCH_TIMEOUT, cache_dir=None):
+    '''Access Swift with the credentials from the `OS_*` variables in `env`.'''
+    if swiftclient is not None:
+        os_options = dict((option, env[name]) for option, name in
+                          SWIFT_OS_OPTIONS if env.get(name))
+        insecure = env.get('SWIFTCLIENT_INSECURE', '').lower() in (
+            'true', '1', 'yes', 'on', 't', 'y')
+        store = SwiftClientStore(
+            env.get('OS_AUTH_URL'), env.get('OS_USERNAME'),
+            env.get('OS_PASSWORD'), env.get('OS_TENANT_NAME'), timeout,
+            env.get('OS_IDENTITY_API_VERSION', '2'), os_options,
+            env.get('OS_CACERT'), insecure)
+    else:
+        store = SwiftCommandStore(env, timeout)
+    if cache_dir:
+        store = CachedStore(store, cache_dir)
+    return store
+
+
+def get_node_hardware_data(store, hw_id, retries=FETCH_RETRIES,
+                           retry_delay=RETRY_DELAY):
+    '''Read the inspector data about the given node from Swift
+
+    Failed downloads are retried with an exponential backoff.
+    '''
+    for attempt in range(retries + 1):
+        try:
+            blob = store.get(INSPECTOR_CONTAINER, hw_id)
+            break
+        except ObjectStoreError:
+            if attempt == retries:
+                raise
+            time.sleep(retry_delay * 2 ** attempt)
+    if isinstance(blob, bytes):
+        blob = blob.decode('utf-8')
+    try:
+        return json.loads(blob)
+    except ValueError as e:
+        raise ObjectStoreError('Invalid inspector data: {}'.format(e))
+
+
+def fetch_node_data(store, hw_id, retries=FETCH_RETRIES,
+                    retry_delay=RETRY_DELAY):
+    '''Returns the `(data, error)` pair of the node.'''
+    try:
+        return (get_node_hardware_data(store, hw_id, retries, retry_delay),
+                None)
+    except ObjectStoreError as e:
+        msg = "Could not read the inspector data of node '{}': {}"
+        return (None, msg.format(hw_id, e))
+
+
+def fetch_inspector_data(store, hardware_ids, threads=FETCH_THREADS,
+                         retries=FETCH_RETRIES, retry_delay=RETRY_DELAY):
+    '''Download the inspector data of all the nodes in a thread pool.
+
+    Returns a list of `(data, error)` pairs in the order of `hardware_ids`.
+    '''
+    def fetch(hw_id):
+        return fetch_node_data(store, hw_id, retries, retry_delay)
+
+    if len(hardware_ids) < 2:
+        return [fetch(hw_id) for hw_id in hardware_ids]
+    pool = ThreadPool(max(1, min(threads, len(hardware_ids))))
+    try:
+        return pool.map(fetch, hardware_ids)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def iter_inspector_data(store, hardware_ids, threads=FETCH_THREADS,
+                        retries=FETCH_RETRIES, retry_delay=RETRY_DELAY):
+    '''Download the inspector data of all the nodes in a thread pool.
+
+    Yields `(hw_id, data, error)` tuples as soon as the downloads finish, so
+    that the data of each node can be dropped once it has been processed.
+    '''
+    def fetch(hw_id):
+        return (hw_id,) + fetch_node_data(store, hw_id, retries, retry_delay)
+
+    if len(hardware_ids) < 2:
+        for hw_id in hardware_ids:
+            yield fetch(hw_id)
+        return
+    pool = ThreadPool(max(1, min(threads, len(hardware_ids))))
+    try:
+        for result in pool.imap_unordered(fetch, hardware_ids):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def pattern_regex(pattern):
+    '''Turn a glob, or a regular expression prefixed with re:, into a regex.'''
+    if pattern.startswith('re:'):
+        return pattern[3:]
+    regex = fnmatch.translate(pattern)
+    # Python 2 appends the flags, which must not end up inside the matcher
+    if regex.endswith('(?ms)'):
+        regex = regex[:-len('(?ms)')]
+    return regex
+
+
+class KeyRules(object):
+    '''
+    Rules for the flattened keys, e.g. `inventory/interfaces/*/mac_address`.
 
+    The patterns of all the rules are compiled into a single regular
+    expression, and the rule of every key is only looked up once.
+    '''
+
+    def __init__(self, ignore=(), must_equal=(), must_unique=()):
+        patterns = {IGNORE: ignore, MUST_EQUAL: must_equal,
+                    MUST_UNIQUE: must_unique}
+        groups = ['(?P<{}>(?:{})\\Z)'.format(
+            rule, '|'.join(pattern_regex(p) for p in patterns[rule]))
+            for rule in RULES if patterns[rule]]
+        self.regex = re.compile('|'.join(groups)) if groups else None
+        self.rules = {}
+        self.ignored_paths = {}
+
+    def rule(self, key):
+        '''The rule applying to the key, None if there is none.'''
+        try:
+            return self.rules[key]
+        except KeyError:
+            pass
+        rule = None
+        match = self.regex.match(key) if self.regex else None
+        if match:
+            groups = match.groupdict()
+            rule = next(name for name in RULES
+                        if groups.get(name) is not None)
+        self.rules[key] = rule
+        return rule
+
+    def ignored(self, key):
+        return self.rule(key) == IGNORE
 
-def all_equal(coll):
-    if len(coll) <= 1:
-        return True
-    first = coll[0]
-    for item in coll[1:]:
-        if item != first:
-            return False
-    return True
+    def ignored_path(self, key):
+        '''Whether the key or any key it is nested in is ignored.'''
+        try:
+            return self.ignored_paths[key]
+        except KeyError:
+            pass
+        parent, separator, _ = key.rpartition('/')
+        ignored = self.ignored(key) or bool(
+            separator and self.ignored_path(parent))
+        self.ignored_paths[key] = ignored
+        return ignored
 
 
-def process_nested_dict(d, prefix=None):
+def load_key_rules(path=None, rules=None):
+    '''
+    Read the key rules from a YAML file and/or a dictionary, e.g.:
+
+    ignore:
+      - logs
+      - 're:.*timestamp.*'
+    must_equal:
+      - cpu_arch
+    must_unique:
+      - inventory/system_vendor/serial_number
+    '''
+    patterns = dict((rule, []) for rule in RULES)
+    sources = []
+    if path:
+        with open(path) as rules_file:
+            sources.append(yaml.safe_load(rules_file) or {})
+    if rules:
+        sources.append(rules)
+    for source in sources:
+        if not isinstance(source, dict):
+            raise ValueError('The key rules must be a dictionary')
+        for rule, rule_patterns in six.iteritems(source):
+            if rule not in patterns:
+                raise ValueError("Unknown key rule '{}', expected one of: {}"
+                                 .format(rule, ', '.join(RULES)))
+            patterns[rule].extend(rule_patterns or [])
+    return KeyRules(**patterns)
+
+
+def process_nested_dict(d, prefix=None, rules=None):
     '''
     Turn a nested dictionary into a flat one.
 
@@ -60,6 +461,9 @@ def process_nested_dict(d, prefix=None):
         'system/os/version': 'CentOS Linux release 7.2.1511 (Core)',
         'network/eth0/businfo': 'pci@0000:00:03.0',
     }
+
+    The keys ignored by the `rules` are left out, along with everything
+    nested in them.
     '''
     result = {}
     for k, v in six.iteritems(d):
@@ -67,15 +471,18 @@ def process_nested_dict(d, prefix=None):
             new_key = prefix + '/' + k
         else:
             new_key = k
+        if rules is not None and rules.ignored(new_key):
+            continue
         if isinstance(v, dict):
-            for k, v in six.iteritems(process_nested_dict(v, new_key)):
+            for k, v in six.iteritems(process_nested_dict(v, new_key,
+                                                          rules)):
                 result[k] = v
         else:
             result[new_key] = v
     return result
 
 
-def process_nested_list(l):
+def process_nested_list(l, rules=None):
     '''
     Turn a list of lists into a single key/value dict.
 
@@ -96,12 +503,14 @@ def process_nested_list(l):
     result = {}
     for item in l:
         key = '/'.join(item[:-1])
+        if rules is not None and rules.ignored_path(key):
+            continue
         value = item[-1]
         result[key] = value
     return result
 
 
-def process_inspector_data(hw_item):
+def process_inspector_data(hw_item, rules=None):
     '''
     Convert the raw ironic inspector data into something easier to work with.
 
@@ -109,55 +518,301 @@ def process_inspector_data(hw_item):
     it to a flat dictionary with nested keys separated by a slash.
     '''
     if isinstance(hw_item, dict):
-        return process_nested_dict(hw_item)
+        return process_nested_dict(hw_item, rules=rules)
     elif isinstance(hw_item, list):
-        return process_nested_list(hw_item)
+        return process_nested_list(hw_item, rules)
     else:
         msg = "The hardware item '{}' must be either a dictionary or a list"
         raise Exception(msg.format(repr(hw_item)))
 
 
+class Column(object):
+    '''
+    The values of one key, dictionary-encoded.
+
+    `rows` are the nodes that have the key and `codes` the positions of their
+    values in `values`, which holds every distinct value once.
+    '''
+
+    __slots__ = ('key', 'rows', 'codes', 'values', 'lookup')
+
+    def __init__(self, key):
+        self.key = key
+        self.rows = array.array('i')
+        self.codes = array.array('i')
+        self.values = []
+        self.lookup = {}
+
+    def encode(self, value):
+        try:
+            encoded = value
+            code = self.lookup.get(value)
+        except TypeError:
+            # Lists and dictionaries are compared by their JSON form
+            encoded = ('unhashable', json.dumps(value, sort_keys=True,
+                                                default=repr))
+            code = self.lookup.get(encoded)
+        if code is None:
+            code = self.lookup[encoded] = len(self.values)
+            self.values.append(value)
+        return code
+
+
+class HardwareTable(object):
+    '''
+    The flattened inspector data of all the nodes, stored by key.
+
+    Every key gets a `Column`, so each distinct value is stored once however
+    many nodes share it. A node without the key counts as having the value
+    None, as in `hw.get(key)`.
+
+    The data is added one node at a time, the flattened dictionaries need
+    not be kept around.
+    '''
+
+    def __init__(self):
+        self.node_ids = []
+        self.columns = {}
+
+    def add_node(self, node_id, hw):
+        node = len(self.node_ids)
+        self.node_ids.append(node_id)
+        columns = self.columns
+        for key, value in six.iteritems(hw):
+            column = columns.get(key)
+            if column is None:
+                column = columns[key] = Column(key)
+            try:
+                code = column.lookup.get(value)
+            except TypeError:
+                code = None
+            if code is None:
+                code = column.encode(value)
+            column.rows.append(node)
+            column.codes.append(code)
+
+    def missing(self, key):
+        '''Number of nodes without the key.'''
+        return len(self.node_ids) - len(self.columns[key].rows)
+
+    def distinct(self, key):
+        '''Number of distinct values of the key, missing counting as None.'''
+        column = self.columns[key]
+        count = len(column.values)
+        if self.missing(key) and None not in column.lookup:
+            count += 1
+        return count
+
+    def differs(self, key):
+        return self.distinct(key) > 1
+
+    def differing_keys(self):
+        '''The keys with more than one value, sorted.'''
+        return sorted(key for key in self.columns if self.differs(key))
+
+    def key_values(self, key):
+        '''The value of the key for every node, in the order they were added.'''
+        column = self.columns[key]
+        values = column.values
+        result = [None] * len(self.node_ids)
+        for node, code in six.moves.zip(column.rows, column.codes):
+            result[node] = values[code]
+        return result
+
+    def value_groups(self, key):
+        '''
+        Group the nodes by the value of the key.
+
+        Returns a list of `(value, node_ids)` pairs, the largest group first.
+        '''
+        column = self.columns[key]
+        groups = [[] for _ in column.values]
+        for node, code in six.moves.zip(column.rows, column.codes):
+            groups[code].append(node)
+        result = list(six.moves.zip(column.values, groups))
+        if self.missing(key):
+            present = set(column.rows)
+            missing = [node for node in range(len(self.node_ids))
+                       if node not in present]
+            if None in column.lookup:
+                result[column.lookup[None]][1].extend(missing)
+            else:
+                result.append((None, missing))
+        result = [(value, sorted(self.node_ids[node] for node in nodes))
+                  for value, nodes in result]
+        result.sort(key=lambda group: (-len(group[1]), group[1]))
+        return result
+
+    def unique(self, key):
+        '''Whether every node having the key has its own value, e.g. MACs.'''
+        column = self.columns[key]
+        return len(column.rows) >= 2 and len(column.values) == len(
+            column.rows)
+
+    def high_cardinality(self, key):
+        '''
+        Whether the key has a value of its own on most of the nodes having it.
+        Such keys, e.g. IPMI addresses, would give each node its own profile.
+        '''
+        column = self.columns[key]
+        distinct = len(column.values)
+        return self.unique(key) or (
+            distinct > 2 and
+            distinct >= len(column.rows) * PROFILE_MAX_DISTINCT_RATIO)
+
+    def unique_keys(self):
+        '''The keys with a different value on every node having them.'''
+        return sorted(key for key in self.columns if self.unique(key))
+
+    def profile_keys(self, patterns=None):
+        '''
+        The keys the nodes are grouped by: the differing keys matching any of
+        the glob `patterns`, or the ones without too many distinct values
+        when no patterns are given.
+        '''
+        keys = self.differing_keys()
+        if patterns:
+            return [key for key in keys
+                    if any(fnmatch.fnmatchcase(key, pattern)
+                           for pattern in patterns)]
+        return [key for key in keys if not self.high_cardinality(key)]
+
+    def node_codes(self, key):
+        '''The code of the value of the key for every node, -1 if missing.'''
+        column = self.columns[key]
+        codes = array.array('i', [column.lookup.get(None, -1)]) * len(
+            self.node_ids)
+        for node, code in six.moves.zip(column.rows, column.codes):
+            codes[node] = code
+        return codes
+
+    def profiles(self, keys):
+        '''
+        Cluster the nodes into hardware profiles by their values of `keys`.
+
+        Returns a list of `(node_ids, values)` pairs, the largest profile
+        first. `values` holds only the keys that distinguish the profile,
+        i.e. the ones where its value is not the most common one.
+        '''
+        columns = [self.node_codes(key) for key in keys]
+        fingerprints = collections.OrderedDict()
+        for node, fingerprint in enumerate(six.moves.zip(*columns)):
+            fingerprints.setdefault(fingerprint, []).append(node)
+        if not columns and self.node_ids:
+            fingerprints[()] = list(range(len(self.node_ids)))
+
+        common = [collections.Counter(codes).most_common(1)[0][0]
+                  for codes in columns]
+        result = []
+        for fingerprint, nodes in six.iteritems(fingerprints):
+            values = {}
+            for key, code, common_code in six.moves.zip(keys, fingerprint,
+                                                        common):
+                if code != common_code:
+                    values[key] = (None if code == -1 else
+                                   self.columns[key].values[code])
+            result.append((sorted(self.node_ids[node] for node in nodes),
+                           values))
+        result.sort(key=lambda profile: (-len(profile[0]), profile[0]))
+        return result
+
+
+def profile_warning(node_ids, values):
+    nodes = ', '.join(node_ids[:PROFILE_MEMBERS_SHOWN])
+    if len(node_ids) > PROFILE_MEMBERS_SHOWN:
+        nodes += ', ...'
+    differences = ', '.join('{}={!r}'.format(key, values[key])
+                            for key in sorted(values))
+    msg = "{} node(s) ({}) differ from the most common hardware: {}"
+    return msg.format(len(node_ids), nodes, differences)
+
+
+def rule_violations(table, rules):
+    '''The keys differing while they must be equal or shared by several
+    nodes while they must be unique.'''
+    violations = []
+    for key in sorted(table.columns):
+        rule = rules.rule(key)
+        if rule == MUST_EQUAL and table.differs(key):
+            values = ', '.join('{!r} ({} node(s))'.format(value, len(node_ids))
+                               for value, node_ids in table.value_groups(key))
+            msg = "The key '{}' must be the same on all nodes but has the values: {}"
+            violations.append(msg.format(key, values))
+        elif (rule == MUST_UNIQUE and
+                table.distinct(key) < len(table.node_ids)):
+            for value, node_ids in table.value_groups(key):
+                if value is not None and len(node_ids) > 1:
+                    msg = "The key '{}' must be unique but has the value {!r} on the nodes: {}"
+                    violations.append(msg.format(key, value,
+                                                 ', '.join(node_ids)))
+    return violations
+
+
 def main():
     module = AnsibleModule(
         argument_spec={
             'os_tenant_name': dict(required=True, type='str'),
             'os_username': dict(required=True, type='str'),
             'os_password': dict(required=True, type='str'),
+            'threads': dict(required=False, type='int',
+                            default=FETCH_THREADS),
+            'timeout': dict(required=False, type='int',
+                            default=FETCH_TIMEOUT),
+            'retries': dict(required=False, type='int',
+                            default=FETCH_RETRIES),
+            'profile_keys': dict(required=False, type='list',
+                                 default=None),
+            'rules_file': dict(required=False, type='str', default=None),
+            'rules': dict(required=False, type='dict', default=None),
+            'cache_dir': dict(required=False, type='str', default=None),
         }
     )
 
+    try:
+        rules = load_key_rules(module.params.get('rules_file'),
+                               module.params.get('rules'))
+    except (IOError, ValueError, re.error, yaml.YAMLError) as e:
+        module.fail_json(msg='Invalid key rules: {}'.format(e))
+
     env = os.environ.copy()
     # NOTE(shadower): Undercloud OS_AUTH_URL should already be in Ansible's env
     env['OS_TENANT_NAME'] = module.params.get('os_tenant_name')
     env['OS_USERNAME'] = module.params.get('os_username')
     env['OS_PASSWORD'] = module.params.get('os_password')
 
-    # TODO(shadower): use python-swiftclient here
-    p = Popen(('swift', 'list', 'ironic-inspector'), env=env, stdout=PIPE, stderr=PIPE)
-    if p.wait() != 0:
-        msg = "Error running `swift list ironic-inspector`: {}".format(
-            p.stderr.read())
-        module.fail_json(msg=msg)
-
-    hardware_ids = [i.strip() for i in p.stdout.read().splitlines() if i.strip()]
-    inspector_data = [get_node_hardware_data(i, env) for i in hardware_ids]
-    processed_data = [process_inspector_data(hw) for hw in inspector_data]
+    cache_dir = module.params.get('cache_dir')
+    store = create_store(env, module.params.get('timeout'),
+                         cache_dir and os.path.expanduser(cache_dir))
 
-    all_keys = set()
-    for hw in processed_data:
-        all_keys.update(hw.keys())
+    try:
+        hardware_ids = store.list(INSPECTOR_CONTAINER)
+    except ObjectStoreError as e:
+        module.fail_json(msg=str(e))
 
-    # TODO(shadower): checks for values that must be different (e.g. mac addresses)
-    diffs = []
+    table = HardwareTable()
+    errors = []
+    for hw_id, data, error in iter_inspector_data(
+            store, hardware_ids, module.params.get('threads'),
+            module.params.get('retries')):
+        if error:
+            errors.append(error)
+        elif not errors:
+            table.add_node(hw_id, process_inspector_data(data, rules))
+        # Only the table keeps the data of the nodes already added
+        del data
+    if errors:
+        module.fail_json(msg='\n'.join(errors))
 
-    for key in all_keys:
-        values = [hw.get(key) for hw in processed_data]
-        if not all_equal(values):
-            msg = "The key '{}' has differing values: {}"
-            diffs.append(msg.format(key, repr(values)))
+    violations = rule_violations(table, rules)
+    profiles = table.profiles(
+        [key for key in table.profile_keys(module.params.get('profile_keys'))
+         if rules.rule(key) != MUST_UNIQUE])
+    diffs = [profile_warning(node_ids, values)
+             for node_ids, values in profiles[1:]]
 
     if diffs:
-        msg = 'Found some differences between the introspected hardware.'
+        msg = ('Found {} hardware profiles among the {} introspected nodes.'
+               .format(len(profiles), len(hardware_ids)))
     else:
         msg = 'No differences found.'
 
@@ -165,7 +820,16 @@ def main():
         'changed': True,
         'msg': msg,
         'warnings': diffs,
+        'profiles': [{'count': len(node_ids), 'nodes': node_ids,
+                      'values': values}
+                     for node_ids, values in profiles],
+        'unique_keys': table.unique_keys(),
+        'violations': violations,
     }
+    if violations:
+        result['msg'] = 'Some keys break the rules: {}'.format(
+            ' '.join(violations))
+        module.fail_json(**result)
     module.exit_json(**result)
 
 
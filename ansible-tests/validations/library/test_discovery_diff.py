@@ -0,0 +1,358 @@
+import hashlib
+import os
+import shutil
+import stat
+import tempfile
+import time
+import unittest
+
+import six
+
+import discovery_diff
+
+
+class FakeStore(object):
+
+    def __init__(self, objects, failures=0, etags=True):
+        self.objects = objects
+        self.failures = failures
+        self.etags = etags
+        self.downloads = []
+
+    def list_objects(self, container):
+        return [(name, hashlib.md5(blob.encode('utf-8')).hexdigest()
+                 if self.etags else None)
+                for name, blob in sorted(self.objects.items())]
+
+    def get(self, container, name):
+        self.downloads.append(name)
+        if self.failures:
+            self.failures -= 1
+            raise discovery_diff.ObjectStoreError('503 Service Unavailable')
+        try:
+            return self.objects[name]
+        except KeyError:
+            raise discovery_diff.ObjectStoreError('404 Not Found')
+
+
+class TestFetchInspectorData(unittest.TestCase):
+
+    def test_results_in_order(self):
+        store = FakeStore(dict(('node{}'.format(i), '{{"cpus": {}}}'.format(i))
+                               for i in range(10)))
+        results = discovery_diff.fetch_inspector_data(
+            store, ['node{}'.format(i) for i in range(10)], threads=4)
+        self.assertEqual([({'cpus': i}, None) for i in range(10)], results)
+
+    def test_retries(self):
+        store = FakeStore({'node': b'{}'}, failures=2)
+        results = discovery_diff.fetch_inspector_data(
+            store, ['node'], retries=2, retry_delay=0)
+        self.assertEqual([({}, None)], results)
+
+    def test_missing_object(self):
+        store = FakeStore({'node': '{}'})
+        results = discovery_diff.fetch_inspector_data(
+            store, ['node', 'gone'], retries=1, retry_delay=0)
+        self.assertEqual(({}, None), results[0])
+        self.assertIsNone(results[1][0])
+        self.assertIn("node 'gone': 404 Not Found", results[1][1])
+
+    def test_invalid_json(self):
+        store = FakeStore({'node': 'not json'})
+        results = discovery_diff.fetch_inspector_data(store, ['node'])
+        self.assertIn('Invalid inspector data', results[0][1])
+
+
+class TestIterInspectorData(unittest.TestCase):
+
+    def test_all_nodes(self):
+        store = FakeStore(dict(('node{}'.format(i), '{{"cpus": {}}}'.format(i))
+                               for i in range(10)))
+        results = discovery_diff.iter_inspector_data(
+            store, ['node{}'.format(i) for i in range(10)] + ['gone'],
+            threads=4, retries=0)
+        results = sorted(results)
+        self.assertEqual([('node{}'.format(i), {'cpus': i}, None)
+                          for i in range(10)], results[1:])
+        self.assertEqual('gone', results[0][0])
+        self.assertIn('404 Not Found', results[0][2])
+
+
+class TestSwiftCommandStore(unittest.TestCase):
+
+    def setUp(self):
+        self.bin_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.bin_dir)
+
+    def store(self, script, timeout=5):
+        path = os.path.join(self.bin_dir, 'swift')
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\n' + script)
+        os.chmod(path, stat.S_IRWXU)
+        env = dict(os.environ)
+        env['PATH'] = os.pathsep.join([self.bin_dir, env.get('PATH', '')])
+        return discovery_diff.SwiftCommandStore(env, timeout)
+
+    def test_list(self):
+        store = self.store('echo node0; echo; echo node1\n')
+        self.assertEqual(['node0', 'node1'],
+                         store.list('ironic-inspector'))
+
+    def test_error(self):
+        store = self.store('echo "Container not found" >&2; exit 1\n')
+        six.assertRaisesRegex(self, discovery_diff.ObjectStoreError,
+                              'Container not found',
+                              store.get, 'ironic-inspector', 'node0')
+
+    def test_timeout_kills_children(self):
+        # The child keeps the output pipe open after its parent is killed
+        store = self.store('sleep 30 & sleep 30\n', timeout=0.5)
+        start = time.time()
+        six.assertRaisesRegex(self, discovery_diff.ObjectStoreError,
+                              'timed out', store.list, 'ironic-inspector')
+        self.assertLess(time.time() - start, 10)
+
+
+class TestCreateStore(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(setattr, discovery_diff, 'swiftclient',
+                        discovery_diff.swiftclient)
+
+    def test_swift_command(self):
+        discovery_diff.swiftclient = None
+        store = discovery_diff.create_store({'OS_AUTH_URL': 'url'})
+        self.assertIsInstance(store, discovery_diff.SwiftCommandStore)
+
+    def test_keystone_v3(self):
+        discovery_diff.swiftclient = object()
+        store = discovery_diff.create_store({
+            'OS_AUTH_URL': 'https://192.0.2.1:13000/v3',
+            'OS_USERNAME': 'admin', 'OS_PASSWORD': 'secret',
+            'OS_TENANT_NAME': 'admin', 'OS_IDENTITY_API_VERSION': '3',
+            'OS_USER_DOMAIN_NAME': 'Default',
+            'OS_PROJECT_DOMAIN_NAME': 'Default', 'OS_REGION_NAME': '',
+            'OS_ENDPOINT_TYPE': 'internalURL',
+            'OS_CACERT': '/etc/pki/ca.crt', 'SWIFTCLIENT_INSECURE': 'true',
+        }, timeout=10)
+        self.assertEqual({
+            'authurl': 'https://192.0.2.1:13000/v3', 'user': 'admin',
+            'key': 'secret', 'tenant_name': 'admin', 'auth_version': '3',
+            'os_options': {'user_domain_name': 'Default',
+                           'project_domain_name': 'Default',
+                           'endpoint_type': 'internalURL'},
+            'cacert': '/etc/pki/ca.crt', 'insecure': True,
+            'timeout': 10, 'retries': 0}, store.connection_args)
+
+    def test_defaults(self):
+        discovery_diff.swiftclient = object()
+        store = discovery_diff.create_store({'OS_AUTH_URL': 'url'})
+        self.assertEqual({}, store.connection_args['os_options'])
+        self.assertIsNone(store.connection_args['cacert'])
+        self.assertFalse(store.connection_args['insecure'])
+        self.assertEqual('2', store.connection_args['auth_version'])
+
+
+class TestCachedStore(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+
+    def fetch(self, store):
+        cached = discovery_diff.CachedStore(store, self.cache_dir)
+        hardware_ids = cached.list('ironic-inspector')
+        return [data for data, _ in discovery_diff.fetch_inspector_data(
+            cached, hardware_ids, retries=0)]
+
+    def test_only_changed_objects_downloaded(self):
+        store = FakeStore({'node0': '{"cpus": 4}', 'node1': '{"cpus": 4}'})
+        self.assertEqual([{'cpus': 4}, {'cpus': 4}], self.fetch(store))
+        self.assertEqual(['node0', 'node1'], sorted(store.downloads))
+
+        store.downloads = []
+        store.objects['node1'] = '{"cpus": 8}'
+        self.assertEqual([{'cpus': 4}, {'cpus': 8}], self.fetch(store))
+        self.assertEqual(['node1'], store.downloads)
+
+    def test_deleted_objects_pruned(self):
+        store = FakeStore({'node0': '{}', 'node1': '{}'})
+        self.fetch(store)
+        del store.objects['node1']
+        store.objects['node0'] = '{"cpus": 8}'
+        self.fetch(store)
+        self.assertEqual(1, len(os.listdir(os.path.join(self.cache_dir,
+                                                        'ironic-inspector'))))
+
+    def test_no_etags(self):
+        store = FakeStore({'node0': '{}'}, etags=False)
+        self.fetch(store)
+        self.fetch(store)
+        self.assertEqual(['node0', 'node0'], store.downloads)
+        self.assertFalse(os.listdir(self.cache_dir))
+
+
+class TestHardwareTable(unittest.TestCase):
+
+    def table(self, *nodes):
+        table = discovery_diff.HardwareTable()
+        for index, hw in enumerate(nodes):
+            table.add_node('node{}'.format(index), hw)
+        return table
+
+    def test_no_differences(self):
+        table = self.table({'cpus': 4, 'disks': ['sda']},
+                           {'cpus': 4, 'disks': ['sda']})
+        self.assertEqual([], table.differing_keys())
+
+    def test_differing_keys(self):
+        table = self.table({'cpus': 4, 'memory_mb': 8192},
+                           {'cpus': 8, 'memory_mb': 8192},
+                           {'cpus': 4, 'memory_mb': 8192})
+        self.assertEqual(['cpus'], table.differing_keys())
+        self.assertEqual([4, 8, 4], table.key_values('cpus'))
+        self.assertEqual([(4, ['node0', 'node2']), (8, ['node1'])],
+                         table.value_groups('cpus'))
+
+    def test_missing_key_is_none(self):
+        table = self.table({'cpus': 4, 'extra': None}, {'cpus': 4},
+                           {'cpus': 4, 'extra': 'x'})
+        self.assertEqual(['extra'], table.differing_keys())
+        self.assertEqual([None, None, 'x'], table.key_values('extra'))
+        self.assertEqual([(None, ['node0', 'node1']), ('x', ['node2'])],
+                         table.value_groups('extra'))
+
+    def test_missing_everywhere_but_none(self):
+        table = self.table({'extra': None}, {})
+        self.assertEqual([], table.differing_keys())
+
+    def test_unhashable_values(self):
+        table = self.table({'disks': ['sda', 'sdb']}, {'disks': ['sda']},
+                           {'disks': ['sda', 'sdb']})
+        self.assertEqual(['disks'], table.differing_keys())
+        self.assertEqual([(['sda', 'sdb'], ['node0', 'node2']),
+                          (['sda'], ['node1'])],
+                         table.value_groups('disks'))
+
+    def test_unique_keys(self):
+        table = self.table({'mac': 'a', 'cpus': 4}, {'mac': 'b', 'cpus': 4},
+                           {'mac': 'c', 'cpus': 8})
+        self.assertEqual(['mac'], table.unique_keys())
+        self.assertEqual(['cpus'], table.profile_keys())
+        self.assertEqual(['mac'], table.profile_keys(['ma?']))
+
+    def test_unique_key_missing_on_some_nodes(self):
+        nodes = [{'cpus': 4, 'serial': 'SN{}'.format(i)} for i in range(10)]
+        del nodes[3]['serial']
+        del nodes[7]['serial']
+        table = self.table(*nodes)
+        self.assertEqual(['serial'], table.unique_keys())
+        self.assertEqual([], table.profile_keys())
+        profiles = table.profiles(table.profile_keys())
+        self.assertEqual(1, len(profiles))
+        self.assertEqual(10, len(profiles[0][0]))
+
+    def test_high_cardinality_key(self):
+        nodes = [{'cpus': 4 if i < 8 else 8, 'ipmi': i % 5}
+                 for i in range(10)]
+        table = self.table(*nodes)
+        self.assertEqual([], table.unique_keys())
+        self.assertEqual(['cpus'], table.profile_keys())
+        self.assertEqual(2, len(table.profiles(table.profile_keys())))
+
+    def test_profiles(self):
+        table = self.table(
+            {'cpus': 4, 'memory_mb': 8192, 'mac': 'a'},
+            {'cpus': 8, 'memory_mb': 8192, 'mac': 'b'},
+            {'cpus': 4, 'memory_mb': 8192, 'mac': 'c'},
+            {'cpus': 8, 'memory_mb': 4096, 'mac': 'd'},
+            {'cpus': 4, 'mac': 'e'})
+        self.assertEqual([(['node0', 'node2'], {}),
+                          (['node1'], {'cpus': 8}),
+                          (['node3'], {'cpus': 8, 'memory_mb': 4096}),
+                          (['node4'], {'memory_mb': None})],
+                         table.profiles(table.profile_keys()))
+
+    def test_single_profile(self):
+        table = self.table({'cpus': 4}, {'cpus': 4})
+        self.assertEqual([(['node0', 'node1'], {})],
+                         table.profiles(table.profile_keys()))
+
+    def test_profile_warning(self):
+        node_ids = ['node{}'.format(i) for i in range(7)]
+        self.assertEqual(
+            "7 node(s) (node0, node1, node2, node3, node4, ...) differ from "
+            "the most common hardware: cpus=8, disks=['sda']",
+            discovery_diff.profile_warning(node_ids,
+                                           {'disks': ['sda'], 'cpus': 8}))
+
+
+class TestKeyRules(unittest.TestCase):
+
+    def setUp(self):
+        self.rules = discovery_diff.KeyRules(
+            ignore=['logs', 'extra/system', 're:.*timestamp.*'],
+            must_equal=['cpu_arch', 'inventory/*/rotational'],
+            must_unique=['interfaces/*/mac', 'inventory/*/serial_number'])
+
+    def test_rule(self):
+        self.assertEqual('ignore', self.rules.rule('logs'))
+        self.assertEqual('ignore', self.rules.rule('extra/boot_timestamp'))
+        self.assertEqual('must_equal', self.rules.rule('cpu_arch'))
+        self.assertEqual('must_unique', self.rules.rule('interfaces/eth0/mac'))
+        self.assertIsNone(self.rules.rule('cpu_arch/x'))
+        self.assertIsNone(self.rules.rule('memory_mb'))
+
+    def test_first_category_wins(self):
+        rules = discovery_diff.KeyRules(ignore=['re:mac.*'],
+                                        must_unique=['mac'])
+        self.assertEqual('ignore', rules.rule('mac'))
+
+    def test_no_rules(self):
+        self.assertIsNone(discovery_diff.KeyRules().rule('cpus'))
+
+    def test_ignored_dict_subtree(self):
+        data = {'cpus': 4, 'logs': 'xyz', 'extra': {
+            'system': {'os': {'version': '7.2'}}, 'cpu': {'count': 4}}}
+        self.assertEqual({'cpus': 4, 'extra/cpu/count': 4},
+                         discovery_diff.process_inspector_data(data,
+                                                               self.rules))
+
+    def test_ignored_list_subtree(self):
+        data = [['cpus', 4], ['logs', 'xyz'],
+                ['extra', 'system', 'os', 'version', '7.2'],
+                ['extra', 'cpu', 'count', 4]]
+        self.assertEqual({'cpus': 4, 'extra/cpu/count': 4},
+                         discovery_diff.process_inspector_data(data,
+                                                               self.rules))
+
+    def test_load_key_rules(self):
+        rules = discovery_diff.load_key_rules(
+            rules={'ignore': ['logs'], 'must_unique': None})
+        self.assertEqual('ignore', rules.rule('logs'))
+        self.assertRaises(ValueError, discovery_diff.load_key_rules,
+                          rules={'must_differ': ['mac']})
+
+    def test_rule_violations(self):
+        table = discovery_diff.HardwareTable()
+        table.add_node('node0', {'cpu_arch': 'x86_64',
+                                 'interfaces/eth0/mac': 'a'})
+        table.add_node('node1', {'cpu_arch': 'x86_64',
+                                 'interfaces/eth0/mac': 'b'})
+        self.assertEqual([],
+                         discovery_diff.rule_violations(table, self.rules))
+        table.add_node('node2', {'cpu_arch': 'ppc64le',
+                                 'interfaces/eth0/mac': 'a'})
+        table.add_node('node3', {})
+        self.assertEqual([
+            "The key 'cpu_arch' must be the same on all nodes but has the "
+            "values: 'x86_64' (2 node(s)), 'ppc64le' (1 node(s)), "
+            "None (1 node(s))",
+            "The key 'interfaces/eth0/mac' must be unique but has the value "
+            "'a' on the nodes: node0, node2",
+        ], discovery_diff.rule_violations(table, self.rules))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,10 @@
 #!/usr/bin/env python
 
 
+import collections
+import os
+import shutil
+import tempfile
 import unittest
 
 import validate_network_environment as validation
@@ -255,6 +259,22 @@ class TestCheckCidrOverlap(unittest.TestCase):
         self.assertEqual('Networks 172.16.10.0/24 and 172.16.11.0/23 overlap.',
                          errors[2])
 
+    def test_overlaps_reported_in_input_order(self):
+        networks = ['172.18.0.0/24', '172.16.10.0/24', '172.18.0.0/16',
+                    '172.16.0.0/16']
+        errors = validation.check_cidr_overlap(networks)
+        self.assertEqual(len(errors), 2)
+        self.assertEqual('Networks 172.18.0.0/24 and 172.18.0.0/16 overlap.',
+                         errors[0])
+        self.assertEqual('Networks 172.16.10.0/24 and 172.16.0.0/16 overlap.',
+                         errors[1])
+
+    def test_ipv4_and_ipv6_networks_do_not_overlap(self):
+        networks = ['0.0.0.0/0', '::/0', '::/96']
+        errors = validation.check_cidr_overlap(networks)
+        self.assertEqual(len(errors), 1)
+        self.assertEqual('Networks ::/0 and ::/96 overlap.', errors[0])
+
 
 class TestCheckAllocationPoolsPairing(unittest.TestCase):
 
@@ -346,6 +366,19 @@ class TestCheckAllocationPoolsPairing(unittest.TestCase):
         self.assertEqual(len(errors), 1)
         self.assertIn('outside of subnet StorageNetCidr', errors[0])
 
+    def test_pool_of_other_ip_version(self):
+        filedata = {
+            'StorageNetCidr': '172.18.0.0/24',
+        }
+        pools = {
+            'StorageAllocationPools': [
+                {'start': '::ffff:172.18.0.10', 'end': '::ffff:172.18.0.20'}
+            ]
+        }
+        errors = validation.check_allocation_pools_pairing(filedata, pools)
+        self.assertEqual(len(errors), 1)
+        self.assertIn('outside of subnet StorageNetCidr', errors[0])
+
     def test_multiple_ranges_and_pools(self):
         filedata = {
             'StorageNetCidr': '172.18.0.0/24',
@@ -482,6 +515,43 @@ class TestStaticIpPoolCollision(unittest.TestCase):
         errors = validation.check_static_ip_pool_collision(static_ips, pools)
         self.assertEqual([], errors)
 
+    def test_static_ip_collide_with_overlapping_pools(self):
+        static_ips = {
+            'ControllerIps': {
+                'internal_api': ['10.35.191.160']
+            }
+        }
+        pools = collections.OrderedDict([
+            ('InternalApiAllocationPools', [
+                {'start': '10.35.191.150', 'end': '10.35.191.240'}
+            ]),
+            ('StorageAllocationPools', [
+                {'start': '10.35.191.100', 'end': '10.35.191.170'}
+            ]),
+        ])
+        errors = validation.check_static_ip_pool_collision(static_ips, pools)
+        self.assertEqual(len(errors), 3)
+        self.assertEqual('Allocation pools InternalApiAllocationPools and '
+                         'StorageAllocationPools overlap: '
+                         '10.35.191.150-10.35.191.240 and '
+                         '10.35.191.100-10.35.191.170.', errors[0])
+        self.assertEqual('IP address 10.35.191.160 from '
+                         'ControllerIps[internal_api] is in the '
+                         'InternalApiAllocationPools pool.', errors[1])
+        self.assertEqual('IP address 10.35.191.160 from '
+                         'ControllerIps[internal_api] is in the '
+                         'StorageAllocationPools pool.', errors[2])
+
+    def test_ranges_of_one_pool_may_overlap(self):
+        pools = {
+            'InternalApiAllocationPools': [
+                {'start': '10.35.191.150', 'end': '10.35.191.240'},
+                {'start': '10.35.191.200', 'end': '10.35.191.250'}
+            ]
+        }
+        errors = validation.check_static_ip_pool_collision({}, pools)
+        self.assertEqual([], errors)
+
 
 class TestVlanIds(unittest.TestCase):
 
@@ -590,6 +660,22 @@ class TestStaticIpInCidr(unittest.TestCase):
         self.assertEqual('The IP address 192.168.101.0 is outside of the'
                          ' StorageNetCidr range: 192.168.100.0/24', errors[0])
 
+    def test_addresses_not_parseable(self):
+        networks = {
+            'StorageNetCidr': '192.168.100.0/24',
+        }
+        static_ips = {
+            'ControllerIps': {
+                'storage': ['nonsense', '192.168.100.120', None, '2001:db8::1']
+            }
+        }
+        errors = validation.check_static_ip_in_cidr(networks, static_ips)
+        self.assertEqual(len(errors), 3)
+        self.assertIn('nonsense is not a valid IP address', errors[0])
+        self.assertIn('None is not a valid IP address', errors[1])
+        self.assertEqual('The IP address 2001:db8::1 is outside of the'
+                         ' StorageNetCidr range: 192.168.100.0/24', errors[2])
+
     def test_addresses_within_cidr(self):
         networks = {
             'StorageNetCidr': '192.168.100.0/24',
@@ -695,5 +781,311 @@ class TestDuplicateStaticIps(unittest.TestCase):
         self.assertEqual([], errors)
 
 
+class TestLoadNicConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'controller.yaml')
+        with open(self.path, 'w') as nic_file:
+            nic_file.write('resources: {}\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        validation.nic_config_cache.clear()
+
+    def test_parsed_once(self):
+        first = validation.load_nic_config(self.path)
+        second = validation.load_nic_config(
+            os.path.join(self.tmp_dir, '.', 'controller.yaml'))
+        self.assertEqual({'resources': {}}, first)
+        self.assertIs(first, second)
+
+    def test_parsed_again_when_changed(self):
+        validation.load_nic_config(self.path)
+        with open(self.path, 'w') as nic_file:
+            nic_file.write('resources: {foo: {}}\n')
+        self.assertEqual({'resources': {'foo': {}}},
+                         validation.load_nic_config(self.path))
+
+    def test_cache_dir(self):
+        cache_dir = os.path.join(self.tmp_dir, 'cache')
+        os.mkdir(cache_dir)
+        validation.load_nic_config(self.path, cache_dir)
+        self.assertEqual(1, len(os.listdir(cache_dir)))
+        validation.nic_config_cache.clear()
+        self.assertEqual({'resources': {}},
+                         validation.load_nic_config(self.path, cache_dir))
+
+    def test_create_cache_dir(self):
+        self.addCleanup(os.environ.__setitem__, 'HOME', os.environ['HOME'])
+        os.environ['HOME'] = self.tmp_dir
+        cache_dir = validation.create_cache_dir('~/.cache/netenv')
+        self.assertEqual(os.path.join(self.tmp_dir, '.cache', 'netenv'),
+                         cache_dir)
+        self.assertTrue(os.path.isdir(cache_dir))
+        self.assertEqual(cache_dir,
+                         validation.create_cache_dir('~/.cache/netenv'))
+        validation.load_nic_config(self.path, cache_dir)
+        self.assertEqual(1, len(os.listdir(cache_dir)))
+
+    def test_create_cache_dir_fails(self):
+        self.assertRaises(OSError, validation.create_cache_dir,
+                          os.path.join(self.path, 'cache'))
+
+    def test_missing_file(self):
+        missing = os.path.join(self.tmp_dir, 'missing.yaml')
+        results = validation.load_nic_configs([self.path, missing])
+        self.assertEqual(({'resources': {}}, None), results[0])
+        self.assertIsNone(results[1][0])
+        self.assertIsInstance(results[1][1], EnvironmentError)
+
+
+class TestReadNetworkEnvironmentFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'network-environment.yaml')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        validation.nic_config_cache.clear()
+
+    def read(self, content):
+        with open(self.path, 'w') as netenv_file:
+            netenv_file.write(content)
+        return validation.read_network_environment_files(self.path)
+
+    def test_no_errors(self):
+        with open(os.path.join(self.tmp_dir, 'controller.yaml'), 'w') as f:
+            f.write('resources: {}\n')
+        nic_name = 'OS::TripleO::Controller::Net::SoftwareConfig'
+        network_data, nic_configs, errors = self.read(
+            'resource_registry:\n  {}: controller.yaml\n'.format(nic_name))
+        self.assertEqual([], errors)
+        self.assertEqual([(nic_name,
+                           os.path.join(self.tmp_dir, 'controller.yaml'),
+                           {'resources': {}})], nic_configs)
+
+    def test_not_a_dict(self):
+        for content in ['', '- foo\n', 'foo\n']:
+            network_data, nic_configs, errors = self.read(content)
+            self.assertEqual({}, network_data)
+            self.assertEqual(['invalid-netenv'],
+                             [error.code for error in errors])
+            self.assertEqual("The network environment file '{}' must be a "
+                             "dictionary.".format(self.path),
+                             errors[0].message)
+
+    def test_empty_sections(self):
+        network_data, nic_configs, errors = self.read(
+            'resource_registry:\nparameter_defaults:\n')
+        self.assertEqual([], errors)
+        self.assertEqual([], validation.validate(self.path))
+
+    def test_section_not_a_dict(self):
+        network_data, nic_configs, errors = self.read(
+            'resource_registry: []\n')
+        self.assertEqual(["The 'resource_registry' section of '{}' must be a "
+                          "dictionary.".format(self.path)],
+                         validation.messages(errors))
+
+
+class TestValidateNetworkEnvironment(unittest.TestCase):
+
+    def test_no_errors(self):
+        network_data = {
+            'parameter_defaults': {
+                'InternalApiNetCidr': '10.35.191.0/24',
+                'InternalApiAllocationPools': [
+                    {'start': '10.35.191.150', 'end': '10.35.191.240'}
+                ],
+                'ControllerIPs': {
+                    'internal_api': ['10.35.191.60', '10.35.191.70']
+                },
+            }
+        }
+        errors = validation.validate_network_environment(network_data, [])
+        self.assertEqual([], errors)
+
+    def test_malformed_parameters_reported_once(self):
+        network_data = {
+            'parameter_defaults': {
+                'InternalApiNetCidr': '10.35.191.0/24',
+                'StorageNetCidr': 'breakit',
+                'ControllerIPs': {
+                    'internal_api': ['nonsense', '10.35.191.60'],
+                    'storage': None,
+                },
+            }
+        }
+        errors = validation.validate_network_environment(network_data, [])
+        self.assertEqual(len(errors), 3)
+        self.assertEqual("Network 'StorageNetCidr' has an invalid CIDR:"
+                         " 'breakit'", errors[0])
+        self.assertIn('The ControllerIPs->storage must be a list.', errors)
+        self.assertEqual(1, len([error for error in errors
+                                 if 'nonsense is not a valid IP' in error]))
+
+    def test_checks_ordered_by_tier(self):
+        network_data = {
+            'parameter_defaults': {
+                'InternalApiNetCidr': '10.35.191.0/24',
+                'InternalApiAllocationPools': [
+                    {'start': '10.35.191.150', 'end': '10.35.191.240'}
+                ],
+                'ControllerIPs': {
+                    'internal_api': ['10.35.191.160', '10.35.192.1', None]
+                },
+                'InternalApiNetworkVlanID': 201,
+                'StorageNetworkVlanID': 201,
+            }
+        }
+        errors = validation.iter_network_environment_errors(network_data, [])
+        codes = [error.code for error in errors]
+        self.assertEqual(['invalid-ip', 'duplicate-vlan', 'ip-in-pool',
+                          'ip-outside-cidr'], codes)
+
+    def test_fail_fast(self):
+        network_data = {
+            'parameter_defaults': {
+                'InternalApiNetCidr': 'breakit',
+                'StorageNetCidr': 'breakit',
+                'InternalApiNetworkVlanID': 201,
+                'StorageNetworkVlanID': 201,
+            }
+        }
+        errors = validation.validate_network_environment(network_data, [],
+                                                         fail_fast=True)
+        self.assertEqual(len(errors), 1)
+        self.assertIn('has an invalid CIDR', errors[0])
+        errors = validation.validate_network_environment(network_data, [])
+        self.assertEqual(len(errors), 3)
+
+    def test_errors_are_generated(self):
+        network_data = {
+            'parameter_defaults': {
+                'InternalApiNetCidr': '10.35.191.0/24',
+                'StorageNetCidr': '10.35.0.0/16',
+                'InternalApiNetworkVlanID': 201,
+                'StorageNetworkVlanID': 201,
+            }
+        }
+        errors = validation.iter_network_environment_errors(network_data, [])
+        error = next(errors)
+        self.assertEqual('cidr-overlap', error.code)
+        self.assertEqual('Networks 10.35.191.0/24 and 10.35.0.0/16 overlap.',
+                         error.message)
+        error = next(errors)
+        self.assertEqual('duplicate-vlan', error.code)
+        self.assertEqual('StorageNetworkVlanID', error.location)
+        self.assertRaises(StopIteration, next, errors)
+
+
+class TestFilterErrors(unittest.TestCase):
+
+    class Unformattable(object):
+        def __format__(self, spec):
+            raise AssertionError('The message must not be formatted.')
+
+    def errors(self):
+        return [
+            validation.ValidationError('cidr-overlap', 'A', '{}',
+                                       self.Unformattable()),
+            validation.ValidationError('pool-overlap', 'B', 'first'),
+            validation.ValidationError('pool-overlap', 'C', 'second'),
+        ]
+
+    def test_ignore(self):
+        errors = validation.filter_errors(self.errors(), ['cidr-overlap'])
+        self.assertEqual(['first', 'second'], validation.messages(errors))
+
+    def test_max_errors(self):
+        errors = validation.filter_errors(self.errors(), ['cidr-overlap'], 1)
+        self.assertEqual(['first'], validation.messages(errors))
+
+    def test_as_dict(self):
+        error = self.errors()[1]
+        self.assertEqual(
+            {'code': 'pool-overlap', 'location': 'B', 'fatal': False,
+             'message': 'first'},
+            error.as_dict())
+
+
+class TestCrossSiteConflicts(unittest.TestCase):
+
+    def netenv(self, **parameter_defaults):
+        return {'parameter_defaults': parameter_defaults}
+
+    def test_empty(self):
+        errors = validation.check_cross_site_conflicts([])
+        self.assertEqual([], errors)
+
+    def test_no_conflicts(self):
+        netenvs = [
+            ('site-a.yaml', self.netenv(
+                StorageNetworkVlanID=30,
+                StorageAllocationPools=[
+                    {'start': '10.0.0.10', 'end': '10.0.0.50'}],
+                ControllerIPs={'storage': ['10.0.0.60']})),
+            ('site-b.yaml', self.netenv(
+                StorageNetworkVlanID=31,
+                StorageAllocationPools=[
+                    {'start': '10.0.1.10', 'end': '10.0.1.50'}],
+                ControllerIPs={'storage': ['10.0.1.60']})),
+        ]
+        errors = validation.check_cross_site_conflicts(netenvs)
+        self.assertEqual([], errors)
+
+    def test_conflicts_within_one_site_ignored(self):
+        netenvs = [
+            ('site-a.yaml', self.netenv(
+                StorageNetworkVlanID=30,
+                TenantNetworkVlanID=30,
+                ControllerIPs={'storage': ['10.0.0.60', '10.0.0.60']})),
+        ]
+        errors = validation.check_cross_site_conflicts(netenvs)
+        self.assertEqual([], errors)
+
+    def test_vlan_id_collision(self):
+        netenvs = [
+            ('site-a.yaml', self.netenv(StorageNetworkVlanID=30)),
+            ('site-b.yaml', self.netenv(TenantNetworkVlanID=30)),
+        ]
+        errors = validation.check_cross_site_conflicts(netenvs)
+        self.assertEqual(len(errors), 1)
+        self.assertEqual('Vlan ID 30 is used by several sites: '
+                         'site-a.yaml[StorageNetworkVlanID], '
+                         'site-b.yaml[TenantNetworkVlanID].', errors[0])
+
+    def test_ip_collisions(self):
+        netenvs = [
+            ('site-a.yaml', self.netenv(
+                StorageAllocationPools=[
+                    {'start': '10.0.0.10', 'end': '10.0.0.50'}],
+                ControllerIPs={'storage': ['10.0.0.60']})),
+            ('site-b.yaml', self.netenv(
+                StorageAllocationPools=[
+                    {'start': '10.0.0.10', 'end': '10.0.0.50'}],
+                ComputeIPs={'storage': ['10.0.0.20', '10.0.0.60']})),
+            ('site-c.yaml', self.netenv(
+                ControllerIPs={'storage': ['10.0.0.60', '10.0.0.70']})),
+        ]
+        errors = validation.check_cross_site_conflicts(netenvs)
+        self.assertEqual(['IP address 10.0.0.60 is used by several sites: '
+                          'ControllerIPs[storage] of site-a.yaml, '
+                          'ComputeIPs[storage] of site-b.yaml, '
+                          'ControllerIPs[storage] of site-c.yaml.'], errors)
+
+    def test_identical_sites(self):
+        netenvs = [('site-{}.yaml'.format(i), self.netenv(
+            StorageNetworkVlanID=30,
+            ControllerIPs={'storage': ['10.0.0.60', '10.0.0.61']},
+            ComputeIPs={'storage': ['10.0.0.70']}))
+            for i in range(100)]
+        errors = list(validation.cross_site_conflicts(netenvs))
+        self.assertEqual(['duplicate-vlan', 'duplicate-ip', 'duplicate-ip',
+                          'duplicate-ip'], [error.code for error in errors])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,162 +1,424 @@
 #!/usr/bin/env python
 
+import bisect
 import collections
+import hashlib
+import heapq
 import itertools
 import netaddr
 import os.path
+import pickle
+import tempfile
 import yaml
 
+from multiprocessing.pool import ThreadPool
+
 import six
 
+try:
+    from collections.abc import Hashable
+except ImportError:
+    from collections import Hashable
+
 from ansible.module_utils.basic import *
 
+# NumPy is optional, static IPs are compared one by one without it.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Prefer the libyaml bindings, they parse several times faster than the pure
+# Python loader.
+try:
+    YamlLoader = yaml.CSafeLoader
+except AttributeError:
+    YamlLoader = yaml.SafeLoader
+
+
+# Version of the files in the NIC config cache directory, parsed data of
+# another PyYAML might differ.
+CACHE_VERSION = (1, yaml.__version__)
+
+# Number of threads parsing NIC config templates.
+NIC_CONFIG_THREADS = 4
+
+# Tiers of the checks by their cost, the structural checks go first and the
+# ones that look at every static IP last.
+STRUCTURAL, CHEAP, EXPENSIVE = range(3)
+
+# Codes of the errors that leave something unparsed, the checks that would
+# look at it are skipped or report noise. `fail_fast` stops at the first one.
+FATAL_CODES = frozenset([
+    'open-failed', 'invalid-netenv', 'invalid-nic-config', 'invalid-parameter',
+    'invalid-cidr', 'invalid-range', 'invalid-ip', 'missing-cidr',
+])
+
+# Parsed NIC config templates of this process, the real path maps to
+# `((path, mtime, size), data)`.
+nic_config_cache = {}
+
+
+def load_yaml(stream):
+    return yaml.load(stream, Loader=YamlLoader)
+
+
+class ValidationError(object):
+    """A problem found in a network environment.
+
+    `code` names the kind of the problem, e.g. `cidr-overlap`, and
+    `location` the parameter or file it was found in. The message is only
+    formatted when it is asked for, so errors that are filtered out by their
+    code cost next to nothing.
+    """
+
+    __slots__ = ('code', 'location', 'template', 'args')
+
+    def __init__(self, code, location, template, *args):
+        self.code = code
+        self.location = location
+        self.template = template
+        self.args = args
+
+    @property
+    def message(self):
+        return self.template.format(*self.args)
+
+    @property
+    def fatal(self):
+        return self.code in FATAL_CODES
+
+    def as_dict(self):
+        return {'code': self.code, 'location': self.location,
+                'fatal': self.fatal, 'message': self.message}
+
+    def __str__(self):
+        return self.message
+
+    def __repr__(self):
+        return '<ValidationError {} at {}: {}>'.format(
+            self.code, self.location, self.message)
+
+
+def messages(errors):
+    return [error.message for error in errors]
+
+
+def filter_errors(errors, ignore=(), max_errors=None):
+    """Skip the errors with an ignored code and stop after `max_errors`."""
+    errors = (error for error in errors if error.code not in ignore)
+    if max_errors is not None:
+        errors = itertools.islice(errors, max_errors)
+    return errors
+
+
+def create_cache_dir(cache_dir):
+    """Expand `~` in the cache directory path and create the directory.
 
-def open_network_environment_files(netenv_path):
+    Raises `OSError` when it can't be created, the parsed templates would
+    silently never be cached otherwise.
+    """
+    cache_dir = os.path.expanduser(cache_dir)
+    try:
+        os.makedirs(cache_dir)
+    except OSError:
+        # Created by another process in the meantime
+        if not os.path.isdir(cache_dir):
+            raise
+    return cache_dir
+
+
+def load_nic_config(path, cache_dir=None):
+    """Parse a NIC config template unless it was parsed before.
+
+    Templates are remembered by their real path, modification time and size,
+    for the rest of the process and in `cache_dir` when given. The cache
+    directory lets separate runs, such as the Ansible module and
+    network-environment-validator.py, share the parsed templates.
+    """
+    real_path = os.path.realpath(path)
+    stat = os.stat(path)
+    key = (real_path, stat.st_mtime, stat.st_size)
+    cached = nic_config_cache.get(real_path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    cache_path = None
+    if cache_dir:
+        cache_path = os.path.join(
+            cache_dir,
+            hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + '.pickle')
+        try:
+            with open(cache_path, 'rb') as cache_file:
+                version, data = pickle.load(cache_file)
+            if version == CACHE_VERSION:
+                nic_config_cache[real_path] = (key, data)
+                return data
+        except Exception:
+            # Missing, outdated or corrupted cache file, parse again
+            pass
+
+    with open(path, 'r') as nic_file:
+        data = load_yaml(nic_file)
+    nic_config_cache[real_path] = (key, data)
+
+    # Write to a temporary file first, concurrent runs never see partial
+    # files.
+    if cache_path:
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=cache_dir)
+            with os.fdopen(fd, 'wb') as cache_file:
+                pickle.dump((CACHE_VERSION, data), cache_file,
+                            pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, cache_path)
+        except (IOError, OSError):
+            pass
+
+    return data
+
+
+def load_nic_configs(paths, cache_dir=None):
+    """Parse NIC config templates in a thread pool.
+
+    Returns a list of `(data, error)` pairs in the order of `paths`.
+    """
+    def load(path):
+        try:
+            return (load_nic_config(path, cache_dir), None)
+        except Exception as e:
+            return (None, e)
+
+    if len(paths) < 2:
+        return [load(path) for path in paths]
+    pool = ThreadPool(min(NIC_CONFIG_THREADS, len(paths)))
+    try:
+        return pool.map(load, paths)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def open_network_environment_files(netenv_path, cache_dir=None):
+    network_data, nic_configs, errors = read_network_environment_files(
+        netenv_path, cache_dir)
+    return (network_data, nic_configs, messages(errors))
+
+
+def read_network_environment_files(netenv_path, cache_dir=None):
     errors = []
     try:
         with open(netenv_path, 'r') as net_file:
-            network_data = yaml.load(net_file)
+            network_data = load_yaml(net_file)
     except Exception as e:
-        return ({}, {}, ["Can't open network environment file '{}': {}"
-                         .format(netenv_path, e)])
+        return ({}, {}, [ValidationError(
+            'open-failed', netenv_path,
+            "Can't open network environment file '{}': {}", netenv_path, e)])
+    if not isinstance(network_data, dict):
+        return ({}, {}, [ValidationError(
+            'invalid-netenv', netenv_path,
+            "The network environment file '{}' must be a dictionary.",
+            netenv_path)])
+    for section in ('resource_registry', 'parameter_defaults'):
+        if network_data.get(section) is not None and not isinstance(
+                network_data[section], dict):
+            return ({}, {}, [ValidationError(
+                'invalid-netenv', netenv_path,
+                "The '{}' section of '{}' must be a dictionary.", section,
+                netenv_path)])
     nic_configs = []
-    resource_registry = network_data.get('resource_registry', {})
+    resource_registry = network_data.get('resource_registry') or {}
+    # Roles often share a template, every file is parsed only once.
+    nic_config_paths = []
+    real_paths = collections.OrderedDict()
     for nic_name, relative_path in six.iteritems(resource_registry):
         if nic_name.endswith("Net::SoftwareConfig"):
             nic_config_path = os.path.join(os.path.dirname(netenv_path),
                                            relative_path)
-            try:
-                with open(nic_config_path, 'r') as nic_file:
-                    nic_configs.append(
-                        (nic_name, nic_config_path, yaml.load(nic_file)))
-            except Exception as e:
-                errors.append(
-                    "Can't open the resource '{}' reference file '{}': {}"
-                    .format(nic_name, nic_config_path, e))
+            real_path = os.path.realpath(nic_config_path)
+            nic_config_paths.append((nic_name, nic_config_path, real_path))
+            real_paths.setdefault(real_path, nic_config_path)
+
+    loaded = dict(zip(real_paths,
+                      load_nic_configs(list(real_paths.values()), cache_dir)))
+    for nic_name, nic_config_path, real_path in nic_config_paths:
+        nic_config, e = loaded[real_path]
+        if e is not None:
+            errors.append(ValidationError(
+                'open-failed', nic_config_path,
+                "Can't open the resource '{}' reference file '{}': {}",
+                nic_name, nic_config_path, e))
+            continue
+        nic_configs.append((nic_name, nic_config_path, nic_config))
 
     return (network_data, nic_configs, errors)
 
 
-def validate(netenv_path):
-    network_data, nic_configs, errors = open_network_environment_files(
-        netenv_path)
-    errors.extend(validate_network_environment(network_data, nic_configs))
-    return errors
+def validate(netenv_path, cache_dir=None, fail_fast=False):
+    return messages(iter_validate(netenv_path, cache_dir, fail_fast))
 
 
-def validate_network_environment(network_data, nic_configs):
-    errors = []
+def iter_validate(netenv_path, cache_dir=None, fail_fast=False):
+    """Generate the `ValidationError`s of a network environment file."""
+    network_data, nic_configs, errors = read_network_environment_files(
+        netenv_path, cache_dir)
+    for error in errors:
+        yield error
+        if fail_fast:
+            return
+    if not network_data:
+        return
+    for error in iter_network_environment_errors(network_data, nic_configs,
+                                                 fail_fast):
+        yield error
 
-    cidrinfo = {}
-    poolsinfo = {}
-    vlaninfo = {}
-    routeinfo = {}
-    bondinfo = {}
-    staticipinfo = {}
 
-    for item, data in six.iteritems(network_data.get('parameter_defaults', {})):
-        if item.endswith('NetCidr'):
-            cidrinfo[item] = data
-        elif item.endswith('AllocationPools'):
-            poolsinfo[item] = data
-        elif item.endswith('NetworkVlanID'):
-            vlaninfo[item] = data
-        elif item.endswith('IPs'):
-            staticipinfo[item] = data
-        elif item == 'ExternalInterfaceDefaultRoute':
-            routeinfo = data
-        elif item == 'BondInterfaceOvsOptions':
-            bondinfo = data
+def validate_network_environment(network_data, nic_configs, fail_fast=False):
+    return messages(iter_network_environment_errors(network_data,
+                                                    nic_configs, fail_fast))
 
+
+def nic_configs_errors(nic_configs):
     for nic_config_name, nic_config_path, nic_config in nic_configs:
-        errors.extend(check_nic_configs(nic_config_path, nic_config))
+        for error in nic_config_errors(nic_config_path, nic_config):
+            yield error
 
-    errors.extend(check_cidr_overlap(cidrinfo.values()))
-    errors.extend(
-        check_allocation_pools_pairing(
-            network_data.get('parameter_defaults', {}), poolsinfo))
-    errors.extend(check_static_ip_pool_collision(staticipinfo, poolsinfo))
-    errors.extend(check_vlan_ids(vlaninfo))
-    errors.extend(check_static_ip_in_cidr(cidrinfo, staticipinfo))
-    errors.extend(duplicate_static_ips(staticipinfo))
 
-    return errors
+# The checks of a network environment as `(tier, check)`, the check takes
+# the `NetworkEnvironment` and the NIC configs. Checks of the same tier run
+# in this order.
+NETWORK_CHECKS = [
+    (STRUCTURAL, lambda netenv, nic_configs: nic_configs_errors(nic_configs)),
+    (STRUCTURAL, lambda netenv, nic_configs: netenv.errors),
+    (CHEAP, lambda netenv, nic_configs: cidr_overlaps(
+        list(netenv.networks.values()))),
+    (CHEAP, lambda netenv, nic_configs: pools_outside_subnets(
+        netenv.pool_ranges, netenv.networks)),
+    (CHEAP, lambda netenv, nic_configs: pool_overlaps(
+        netenv.pool_ranges, netenv.range_index())),
+    (CHEAP, lambda netenv, nic_configs: vlan_id_collisions(netenv.vlans)),
+    (EXPENSIVE, lambda netenv, nic_configs: static_ip_pool_collisions(
+        netenv.static_ips, netenv.pool_ranges, netenv.range_index())),
+    (EXPENSIVE, lambda netenv, nic_configs: static_ips_outside_networks(
+        netenv.parsed_static_ips(), netenv.networks)),
+    (EXPENSIVE, lambda netenv, nic_configs: duplicate_ips(netenv.static_ips)),
+]
+
+
+def iter_network_environment_errors(network_data, nic_configs,
+                                    fail_fast=False):
+    """Generate the `ValidationError`s of loaded network environment data.
+
+    The checks run tier by tier, see `NETWORK_CHECKS`, and only as far as the
+    errors are consumed. With `fail_fast` nothing runs after the first fatal
+    error.
+    """
+    # Parse the CIDRs, pools and static IPs once and report the malformed
+    # ones first, the other checks only look at what could be parsed.
+    netenv = normalize_network_environment(
+        network_data.get('parameter_defaults') or {})
+
+    checks = sorted(NETWORK_CHECKS, key=lambda check: check[0])
+    for tier, check in checks:
+        for error in check(netenv, nic_configs):
+            yield error
+            if fail_fast and error.fatal:
+                return
 
 
 def check_nic_configs(path, nic_data):
-    errors = []
+    return messages(nic_config_errors(path, nic_data))
+
 
+def nic_config_errors(path, nic_data):
     if not isinstance(nic_data, collections.Mapping):
-        return ["The nic_data parameter must be a dictionary."]
+        yield ValidationError(
+            'invalid-nic-config', path,
+            "The nic_data parameter must be a dictionary.")
+        return
 
     # Look though every resources bridges and make sure there is only a single
     # bond per bridge and only 1 interface per bridge if there are no bonds.
     resources = nic_data.get('resources')
     if not isinstance(resources, collections.Mapping):
-        return ["The nic_data must contain the 'resources' key and it must be "
-                "a dictionary."]
+        yield ValidationError(
+            'invalid-nic-config', path,
+            "The nic_data must contain the 'resources' key and it must be "
+            "a dictionary.")
+        return
     for name, resource in six.iteritems(resources):
         if not isinstance(resource, collections.Mapping):
-            errors.append("'{}' is not a valid resource.".format(name))
+            yield ValidationError('invalid-nic-config', path,
+                                  "'{}' is not a valid resource.", name)
             continue
         properties = resource.get('properties')
         if not isinstance(properties, collections.Mapping):
-            errors.append("The '{}' resource must contain 'properties'."
-                          .format(name))
+            yield ValidationError(
+                'invalid-nic-config', path,
+                "The '{}' resource must contain 'properties'.", name)
             continue
         if 'config' not in properties:
             continue
         else:
             config = properties.get('config')
             if not isinstance(config, collections.Mapping):
-                errors.append(
-                    "The 'config' property of '{}' must be a dictionary."
-                    .format(name))
+                yield ValidationError(
+                    'invalid-nic-config', path,
+                    "The 'config' property of '{}' must be a dictionary.",
+                    name)
                 continue
         if 'os_net_config' not in config:
             continue
         else:
             os_net_config = config.get('os_net_config')
             if not isinstance(os_net_config, collections.Mapping):
-                errors.append(
-                    "The 'os_net_config' section of '{}' must be a dictionary."
-                    .format(name))
+                yield ValidationError(
+                    'invalid-nic-config', path,
+                    "The 'os_net_config' section of '{}' must be a "
+                    "dictionary.", name)
                 continue
         if 'network_config' in os_net_config:
             bridges = os_net_config['network_config']
         else:
             continue
         if not isinstance(bridges, collections.Iterable):
-            errors.append("The 'network_config' section of '{}' must be a list."
-                          .format(name))
+            yield ValidationError(
+                'invalid-nic-config', path,
+                "The 'network_config' section of '{}' must be a list.", name)
             continue
         for bridge in bridges:
             if 'type' not in bridge:
-                errors.append("The bridge item {} in {} {} must have a type."
-                              .format(bridge, name, path))
+                yield ValidationError(
+                    'invalid-nic-config', path,
+                    "The bridge item {} in {} {} must have a type.",
+                    bridge, name, path)
                 continue
             if 'name' not in bridge:
-                errors.append("The bridge item {} in {} {} must have a name."
-                              .format(bridge, name, path))
+                yield ValidationError(
+                    'invalid-nic-config', path,
+                    "The bridge item {} in {} {} must have a name.",
+                    bridge, name, path)
                 continue
             if bridge['type'] == 'ovs_bridge':
                 bond_count = 0
                 interface_count = 0
                 if not isinstance(bridge.get('members'), collections.Iterable):
-                    errors.append(
-                        "OVS bridge {} in {} {} must contain a 'members' list."
-                        .format(bridge, name, path))
+                    yield ValidationError(
+                        'invalid-nic-config', path,
+                        "OVS bridge {} in {} {} must contain a 'members' "
+                        "list.", bridge, name, path)
                     continue
                 for bond in bridge['members']:
                     if not isinstance(bond, collections.Mapping):
-                        errors.append(
-                            "The {} bond in {} {} must be a dictionary."
-                            .format(bond, name, path))
+                        yield ValidationError(
+                            'invalid-nic-config', path,
+                            "The {} bond in {} {} must be a dictionary.",
+                            bond, name, path)
                         continue
                     if 'type' not in bond:
-                        errors.append(
-                            "The {} bond in {} {} must have a type."
-                            .format(bond, name, path))
+                        yield ValidationError(
+                            'invalid-nic-config', path,
+                            "The {} bond in {} {} must have a type.",
+                            bond, name, path)
                         continue
                     if bond['type'] == 'ovs_bond':
                         bond_count += 1
@@ -168,17 +430,222 @@ def check_nic_configs(path, nic_data):
                         pass
 
                 if bond_count == 2:
-                    errors.append(
+                    yield ValidationError(
+                        'invalid-bonding', path,
                         'Invalid bonding: There are 2 bonds for'
-                        ' bridge {} of resource {} in {}'.format(
-                            bridge['name'], name, path))
+                        ' bridge {} of resource {} in {}',
+                        bridge['name'], name, path)
                 if bond_count == 0 and interface_count > 1:
-                    errors.append(
+                    yield ValidationError(
+                        'invalid-interface', path,
                         'Invalid interface: When not using a bond, '
                         'there can only be 1 interface for bridge {} '
-                        'of resource {} in {}'.format(
-                            bridge['name'], name, path))
-    return errors
+                        'of resource {} in {}',
+                        bridge['name'], name, path)
+
+
+class Network(object):
+    """A parsed `*NetCidr` parameter."""
+
+    __slots__ = ('name', 'cidr', 'ip_network', 'first', 'last')
+
+    def __init__(self, name, cidr):
+        self.name = name
+        self.cidr = cidr
+        self.ip_network = netaddr.IPNetwork(cidr)
+        self.first, self.last = ip_interval(self.ip_network.first,
+                                            self.ip_network.last,
+                                            self.ip_network.version)
+
+
+class PoolRange(object):
+    """A parsed range of a `*AllocationPools` parameter."""
+
+    __slots__ = ('pool', 'pool_data', 'ip_range', 'first', 'last')
+
+    def __init__(self, pool, pool_data, allocation_range):
+        self.pool = pool
+        self.pool_data = pool_data
+        self.ip_range = netaddr.IPRange(
+            netaddr.IPAddress(allocation_range['start']),
+            netaddr.IPAddress(allocation_range['end']))
+        self.first, self.last = ip_interval(self.ip_range.first,
+                                            self.ip_range.last,
+                                            self.ip_range.version)
+
+
+class StaticIPs(object):
+    """The static IPs of one service of a role in a `*IPs` parameter.
+
+    `ips` is None when the service does not hold a list. The addresses that
+    could be parsed are in `valid` with their integer values in `addresses`,
+    the rest is in `invalid` as `(ip, error)` pairs.
+    """
+
+    __slots__ = ('role', 'service', 'ips', 'valid', 'addresses', 'invalid')
+
+    def __init__(self, role, service, ips):
+        self.role = role
+        self.service = service
+        self.ips = None
+        self.valid = []
+        self.addresses = []
+        self.invalid = []
+        if not isinstance(ips, collections.Iterable):
+            return
+        self.ips = list(ips)
+        for ip in self.ips:
+            try:
+                address = netaddr.IPAddress(ip)
+            except (netaddr.AddrFormatError, TypeError) as e:
+                self.invalid.append((ip, e))
+                continue
+            self.valid.append(ip)
+            self.addresses.append(
+                ip_interval(int(address), int(address), address.version)[0])
+
+
+class NetworkEnvironment(object):
+    """The `parameter_defaults` of a network environment parsed for checks.
+
+    Every CIDR, allocation pool and static IP is parsed only once. The
+    parameters that could not be parsed are described by the
+    `ValidationError`s in `errors`.
+    """
+
+    __slots__ = ('networks', 'invalid_networks', 'pool_ranges', 'static_ips',
+                 'vlans', 'errors', '_range_index')
+
+    def __init__(self, networks, invalid_networks, pool_ranges, static_ips,
+                 vlans, errors):
+        self.networks = networks
+        self.invalid_networks = invalid_networks
+        self.pool_ranges = pool_ranges
+        self.static_ips = static_ips
+        self.vlans = vlans
+        self.errors = errors
+        self._range_index = None
+
+    def range_index(self):
+        """The `build_range_index` of the allocation pools, built once."""
+        if self._range_index is None:
+            self._range_index = build_range_index(self.pool_ranges)
+        return self._range_index
+
+    def parsed_static_ips(self):
+        """The static IPs except those of the networks that did not parse."""
+        return [service for service in self.static_ips
+                if service_subnet(service.service) not in
+                self.invalid_networks]
+
+
+def normalize_network_environment(parameter_defaults):
+    errors = []
+    cidrinfo = {}
+    poolsinfo = {}
+    vlaninfo = {}
+    staticipinfo = {}
+
+    for item, data in six.iteritems(parameter_defaults):
+        if item.endswith('NetCidr'):
+            cidrinfo[item] = data
+        elif item.endswith('AllocationPools'):
+            poolsinfo[item] = data
+        elif item.endswith('NetworkVlanID'):
+            vlaninfo[item] = data
+        elif item.endswith('IPs'):
+            staticipinfo[item] = data
+
+    networks = parse_networks(cidrinfo, errors)
+    invalid_networks = set(cidrinfo) - set(networks)
+    pool_ranges = parse_pools(poolsinfo, errors)
+    for pool_name, pool_data in six.iteritems(poolsinfo):
+        subnet_item = pool_subnet(pool_name)
+        if (isinstance(pool_data, collections.Iterable) and
+                subnet_item not in cidrinfo):
+            errors.append(ValidationError(
+                'missing-cidr', pool_name,
+                'The {} CIDR is not specified for {}.',
+                subnet_item, pool_name))
+    static_ips = parse_static_ips(staticipinfo, errors)
+    errors.extend(static_ips_not_lists(static_ips))
+    errors.extend(invalid_static_ips(static_ips))
+
+    return NetworkEnvironment(networks, invalid_networks, pool_ranges,
+                              static_ips, vlaninfo, errors)
+
+
+def parse_networks(networks, errors):
+    parsed = collections.OrderedDict()
+    for name, cidr in six.iteritems(networks):
+        try:
+            parsed[name] = Network(name, cidr)
+        except Exception:
+            errors.append(ValidationError(
+                'invalid-cidr', name,
+                "Network '{}' has an invalid CIDR: '{}'", name, cidr))
+    return parsed
+
+
+def parse_pools(pools, errors):
+    pool_ranges = []
+    for pool_name, pool_data in six.iteritems(pools):
+        if not isinstance(pool_data, collections.Iterable):
+            errors.append(ValidationError(
+                'invalid-parameter', pool_name,
+                "The IP ranges in {} must form a list.", pool_name))
+            continue
+        for allocation_range in pool_data:
+            try:
+                pool_ranges.append(
+                    PoolRange(pool_name, pool_data, allocation_range))
+            except Exception:
+                errors.append(ValidationError(
+                    'invalid-range', pool_name,
+                    "Invalid format of the IP range in {}: {}",
+                    pool_name, allocation_range))
+    return pool_ranges
+
+
+def parse_static_ips(static_ips, errors):
+    parsed = []
+    for role, services in six.iteritems(static_ips):
+        if not isinstance(services, collections.Mapping):
+            errors.append(ValidationError(
+                'invalid-parameter', role,
+                "The {} must be a dictionary.", role))
+            continue
+        for service, ips in six.iteritems(services):
+            parsed.append(StaticIPs(role, service, ips))
+    return parsed
+
+
+def pool_subnet(pool_name):
+    return pool_name.split('AllocationPools')[0] + 'NetCidr'
+
+
+def service_subnet(service):
+    return service.title().replace('_', '') + 'NetCidr'
+
+
+def service_location(service):
+    return '{}[{}]'.format(service.role, service.service)
+
+
+def static_ips_not_lists(static_ips,
+                         template="The {}->{} must be a list."):
+    for service in static_ips:
+        if service.ips is None:
+            yield ValidationError('invalid-parameter',
+                                  service_location(service), template,
+                                  service.role, service.service)
+
+
+def invalid_static_ips(static_ips):
+    for service in static_ips:
+        for ip, e in service.invalid:
+            yield ValidationError('invalid-ip', service_location(service),
+                                  "{} is not a valid IP address: {}", ip, e)
 
 
 def check_cidr_overlap(networks):
@@ -188,16 +655,63 @@ def check_cidr_overlap(networks):
         return ["The argument must be iterable."]
     for x in networks:
         try:
-            objs.append(netaddr.IPNetwork(x))
-        except (ValueError, TypeError):
-            errors.append('Invalid network: {}'.format(x))
-
-    for net1, net2 in itertools.combinations(objs, 2):
-        if (net1 in net2 or net2 in net1):
-            errors.append(
-                'Networks {} and {} overlap.'
-                .format(net1, net2))
-    return errors
+            objs.append(Network(None, x))
+        except (netaddr.AddrFormatError, ValueError, TypeError):
+            errors.append(ValidationError('invalid-cidr', x,
+                                          'Invalid network: {}', x))
+    errors.extend(cidr_overlaps(objs))
+    return messages(errors)
+
+
+def cidr_overlaps(networks):
+    intervals = [(network.first, network.last) for network in networks]
+    for i, j in overlapping_intervals(intervals):
+        yield ValidationError(
+            'cidr-overlap', networks[i].name, 'Networks {} and {} overlap.',
+            networks[i].ip_network, networks[j].ip_network)
+
+
+def ip_interval(first, last, version):
+    """Turn an address range into an integer interval.
+
+    IPv6 intervals are shifted above all IPv4 ones so that the two address
+    families never overlap.
+    """
+    if version == 6:
+        return (first + (1 << 128), last + (1 << 128))
+    return (first, last)
+
+
+def ip_address(value):
+    """Turn an integer from `ip_interval` back into an IP address."""
+    if value >= (1 << 128):
+        return netaddr.IPAddress(value - (1 << 128), 6)
+    return netaddr.IPAddress(value, 4)
+
+
+def overlapping_intervals(intervals):
+    """Find all overlapping pairs in a list of `(first, last)` intervals.
+
+    This is a sort and sweep: the intervals are visited by their start and a
+    heap keeps the ones that are still open. Every interval overlaps with all
+    the open ones, so the cost is O(n log n) plus the number of overlaps
+    instead of comparing every pair.
+
+    Returns the `(i, j)` index pairs with `i < j` in the same order as
+    `itertools.combinations` would.
+    """
+    pairs = []
+    active = []
+    order = sorted(range(len(intervals)), key=lambda i: intervals[i])
+    for index in order:
+        first, last = intervals[index]
+        while active and active[0][0] < first:
+            heapq.heappop(active)
+        for _, other in active:
+            pairs.append((min(index, other), max(index, other)))
+        heapq.heappush(active, (last, index))
+    pairs.sort()
+    return pairs
 
 
 def check_allocation_pools_pairing(filedata, pools):
@@ -206,44 +720,41 @@ def check_allocation_pools_pairing(filedata, pools):
     if not isinstance(pools, collections.Mapping):
         return ["The second argument must be a dictionary."]
     errors = []
+    pool_ranges = parse_pools(pools, errors)
+    networks = {}
     for poolitem, pooldata in six.iteritems(pools):
-        pool_objs = []
         if not isinstance(pooldata, collections.Iterable):
-            errors.append('The IP ranges in {} must form a list.'
-                          .format(poolitem))
             continue
-        for dict_range in pooldata:
-            try:
-                pool_objs.append(netaddr.IPRange(
-                    netaddr.IPAddress(dict_range['start']),
-                    netaddr.IPAddress(dict_range['end'])))
-            except Exception:
-                errors.append("Invalid format of the IP range in {}: {}"
-                              .format(poolitem, dict_range))
-                continue
-
-        subnet_item = poolitem.split('AllocationPools')[0] + 'NetCidr'
+        subnet_item = pool_subnet(poolitem)
         try:
             network = filedata[subnet_item]
-            subnet_obj = netaddr.IPNetwork(network)
+            networks[subnet_item] = Network(subnet_item, network)
         except KeyError:
-            errors.append('The {} CIDR is not specified for {}.'
-                          .format(subnet_item, poolitem))
-            continue
+            errors.append(ValidationError(
+                'missing-cidr', poolitem,
+                'The {} CIDR is not specified for {}.',
+                subnet_item, poolitem))
         except Exception:
-            errors.append('Invalid IP network: {}'.format(network))
-            continue
+            errors.append(ValidationError(
+                'invalid-cidr', subnet_item,
+                'Invalid IP network: {}', network))
+    errors.extend(pools_outside_subnets(pool_ranges, networks))
+    return messages(errors)
 
-        for ranges in pool_objs:
-            for range in ranges:
-                if range not in subnet_obj:
-                    errors.append('Allocation pool {} {} outside of subnet'
-                                  ' {}: {}'.format(poolitem,
-                                                   pooldata,
-                                                   subnet_item,
-                                                   subnet_obj))
-                    break
-    return errors
+
+def pools_outside_subnets(pool_ranges, networks):
+    # A range is inside the subnet when both of its ends are.
+    for pool_range in pool_ranges:
+        subnet_item = pool_subnet(pool_range.pool)
+        if subnet_item not in networks:
+            continue
+        network = networks[subnet_item]
+        if pool_range.first < network.first or pool_range.last > network.last:
+            yield ValidationError(
+                'pool-outside-subnet', pool_range.pool,
+                'Allocation pool {} {} outside of subnet {}: {}',
+                pool_range.pool, pool_range.pool_data, subnet_item,
+                network.ip_network)
 
 
 def check_static_ip_pool_collision(static_ips, pools):
@@ -265,73 +776,123 @@ def check_static_ip_pool_collision(static_ips, pools):
     if not isinstance(pools, collections.Mapping):
         return ["The Pools input must be a dictionary."]
     errors = []
-    pool_ranges = []
-    for pool_name, ranges in six.iteritems(pools):
-        if not isinstance(ranges, collections.Iterable):
-            errors.append("The IP ranges in {} must form a list."
-                          .format(pool_name))
-            continue
-        for allocation_range in ranges:
-            try:
-                ip_range = netaddr.IPRange(allocation_range['start'],
-                                           allocation_range['end'])
-            except Exception:
-                errors.append("Invalid format of the IP range in {}: {}"
-                              .format(pool_name, allocation_range))
-                continue
-            pool_ranges.append((pool_name, ip_range))
+    pool_ranges = parse_pools(pools, errors)
+    services = parse_static_ips(static_ips, errors)
+    errors.extend(static_ips_not_lists(
+        services, "The {}->{} must be an array."))
+    errors.extend(invalid_static_ips(services))
+    pool_index = build_range_index(pool_ranges)
+    errors.extend(pool_overlaps(pool_ranges, pool_index))
+    errors.extend(static_ip_pool_collisions(services, pool_ranges,
+                                            pool_index))
+    return messages(errors)
 
-    for role, services in six.iteritems(static_ips):
-        if not isinstance(services, collections.Mapping):
-            errors.append("The {} must be a dictionary.".format(role))
-            continue
-        for service, ips in six.iteritems(services):
-            if not isinstance(ips, collections.Iterable):
-                errors.append("The {}->{} must be an array."
-                              .format(role, service))
-                continue
-            for ip in ips:
-                try:
-                    ip = netaddr.IPAddress(ip)
-                except netaddr.AddrFormatError as e:
-                    errors.append("{} is not a valid IP address: {}"
-                                  .format(ip, e))
-                    continue
-                ranges_with_conflict = ranges_conflicting_with_ip(
-                    ip, pool_ranges)
-                if ranges_with_conflict:
-                    for pool_name, ip_range in ranges_with_conflict:
-                        msg = "IP address {} from {}[{}] is in the {} pool."
-                        errors.append(msg.format(
-                            ip, role, service, pool_name))
-    return errors
+
+def pool_overlaps(pool_ranges, pool_index=None):
+    if pool_index is None:
+        pool_index = build_range_index(pool_ranges)
+    for i, j in pool_index[3]:
+        range1 = pool_ranges[i]
+        range2 = pool_ranges[j]
+        if range1.pool != range2.pool:
+            yield ValidationError(
+                'pool-overlap', range1.pool,
+                "Allocation pools {} and {} overlap: {} and {}.",
+                range1.pool, range2.pool, range1.ip_range, range2.ip_range)
+
+
+def static_ip_pool_collisions(static_ips, pool_ranges, pool_index=None):
+    if pool_index is None:
+        pool_index = build_range_index(pool_ranges)
+    for service in static_ips:
+        for address in service.addresses:
+            ranges_with_conflict = ranges_conflicting_with_ip(
+                address, pool_index)
+            for pool_range in ranges_with_conflict:
+                yield ValidationError(
+                    'ip-in-pool', service_location(service),
+                    "IP address {} from {}[{}] is in the {} pool.",
+                    ip_address(address), service.role, service.service,
+                    pool_range.pool)
 
 
-def ranges_conflicting_with_ip(ip_address, ip_ranges):
+def build_range_index(pool_ranges):
+    """Build an index of IP ranges for `ranges_conflicting_with_ip`.
+
+    This takes a list of `PoolRange`s and sorts them by their first address.
+    Next to the starts, the index keeps the highest last address seen so far,
+    which tells a lookup when to stop.
+
+    The same pass finds the overlapping ranges: a heap keeps the ranges that
+    are still open at each start, and all of them overlap with the range
+    starting there. Building the index costs O(n log n) plus the number of
+    overlaps.
+
+    Returns `(starts, reach, entries, overlaps)`, where `overlaps` are the
+    `(i, j)` pairs of positions in `pool_ranges` with `i < j`, in the same
+    order as `itertools.combinations` would give them.
+    """
+    entries = sorted(
+        ((pool_range.first, pool_range.last), position, pool_range)
+        for position, pool_range in enumerate(pool_ranges))
+    starts = []
+    reach = []
+    overlaps = []
+    active = []
+    for (first, last), position, _ in entries:
+        starts.append(first)
+        reach.append(max(last, reach[-1]) if reach else last)
+        while active and active[0][0] < first:
+            heapq.heappop(active)
+        for _, other in active:
+            overlaps.append((min(position, other), max(position, other)))
+        heapq.heappush(active, (last, position))
+    overlaps.sort()
+    return starts, reach, entries, overlaps
+
+
+def ranges_conflicting_with_ip(address, index):
     """Check for all conflicts of the IP address conflicts.
 
-    This takes a single IP address and a list of `(pool_name,
-    netenv.IPRange)`s.
+    This takes a single IP address as an integer from `ip_interval` and an
+    index of the ranges built by `build_range_index`. The ranges starting at
+    or before the address are found by bisection and walked back only while
+    they can still reach it. Among disjoint ranges, the usual allocation
+    pools, a lookup costs O(log n) plus the number of conflicts. A wide range
+    starting early keeps the reach up for all the ranges after it though, and
+    in the worst case a lookup walks back over all the n ranges, O(n).
 
-    We return all ranges that the IP address conflicts with. This is to
-    improve the final error messages.
+    We return all ranges that the IP address conflicts with, in the order
+    they were given to the index. This is to improve the final error
+    messages.
     """
-    return [(pool_name, ip_range) for (pool_name, ip_range) in ip_ranges
-            if ip_address in ip_range]
+    starts, reach, entries, _ = index
+    conflicts = []
+    position = bisect.bisect_right(starts, address)
+    while position > 0 and reach[position - 1] >= address:
+        position -= 1
+        (_, last), order, pool_range = entries[position]
+        if last >= address:
+            conflicts.append((order, pool_range))
+    conflicts.sort(key=lambda conflict: conflict[0])
+    return [pool_range for _, pool_range in conflicts]
 
 
 def check_vlan_ids(vlans):
     if not isinstance(vlans, collections.Mapping):
         return ["The vlans parameter must be a dictionary."]
-    errors = []
+    return messages(vlan_id_collisions(vlans))
+
+
+def vlan_id_collisions(vlans):
     invertdict = {}
     for k, v in six.iteritems(vlans):
         if v not in invertdict:
             invertdict[v] = k
         else:
-            errors.append('Vlan ID {} ({}) already exists in {}'.format(
-                v, k, invertdict[v]))
-    return errors
+            yield ValidationError('duplicate-vlan', k,
+                                  'Vlan ID {} ({}) already exists in {}',
+                                  v, k, invertdict[v])
 
 
 def check_static_ip_in_cidr(networks, static_ips):
@@ -344,70 +905,139 @@ def check_static_ip_in_cidr(networks, static_ips):
     if not isinstance(static_ips, collections.Mapping):
         return ["The static_ips argument must be a dictionary."]
     errors = []
-    network_ranges = {}
-    # TODO(shadower): Refactor this so networks are always valid and already
-    # converted to `netaddr.IPNetwork` here. Will be useful in the other checks.
-    for name, cidr in six.iteritems(networks):
-        try:
-            network_ranges[name] = netaddr.IPNetwork(cidr)
-        except Exception:
-            errors.append("Network '{}' has an invalid CIDR: '{}'"
-                          .format(name, cidr))
-    for role, services in six.iteritems(static_ips):
-        if not isinstance(services, collections.Mapping):
-            errors.append("The {} must be a dictionary.".format(role))
+    network_ranges = parse_networks(networks, errors)
+    services = parse_static_ips(static_ips, errors)
+    with_range = [service for service in services
+                  if service_subnet(service.service) in network_ranges]
+    errors.extend(static_ips_not_lists(with_range))
+    errors.extend(invalid_static_ips(with_range))
+    errors.extend(static_ips_outside_networks(services, network_ranges))
+    return messages(errors)
+
+
+def static_ips_outside_networks(static_ips, networks):
+    for service in static_ips:
+        range_name = service_subnet(service.service)
+        if range_name not in networks:
+            yield ValidationError(
+                'missing-cidr', service_location(service),
+                "Service '{}' does not have a corresponding range: '{}'.",
+                service.service, range_name)
             continue
-        for service, ips in six.iteritems(services):
-            range_name = service.title().replace('_', '') + 'NetCidr'
-            if range_name in network_ranges:
-                if not isinstance(ips, collections.Iterable):
-                    errors.append("The {}->{} must be a list."
-                                  .format(role, service))
-                    continue
-                for ip in ips:
-                    if ip not in network_ranges[range_name]:
-                        errors.append(
-                            "The IP address {} is outside of the {} range: {}"
-                            .format(ip, range_name, networks[range_name]))
-            else:
-                errors.append(
-                    "Service '{}' does not have a "
-                    "corresponding range: '{}'.".format(service, range_name))
-    return errors
+        network = networks[range_name]
+        for index in addresses_outside(service.addresses, network.first,
+                                       network.last):
+            yield ValidationError(
+                'ip-outside-cidr', service_location(service),
+                "The IP address {} is outside of the {} range: {}",
+                service.valid[index], range_name, network.cidr)
+
+
+def addresses_outside(addresses, first, last):
+    '''
+    Return the indexes of the integer addresses that are not within the
+    `first` and `last` address. The comparison is done on a NumPy array when
+    NumPy is installed and all the values fit into it.
+    '''
+    if (numpy is not None and addresses and
+            max(addresses) < (1 << 63) and last < (1 << 63)):
+        values = numpy.array(addresses, dtype=numpy.int64)
+        return numpy.flatnonzero((values < first) | (values > last)).tolist()
+    return [index for index, address in enumerate(addresses)
+            if address < first or address > last]
 
 
 def duplicate_static_ips(static_ips):
     errors = []
     if not isinstance(static_ips, collections.Mapping):
         return ["The static_ips argument must be a dictionary."]
+    services = parse_static_ips(static_ips, errors)
+    errors.extend(static_ips_not_lists(services))
+    errors.extend(duplicate_ips(services))
+    return messages(errors)
+
+
+def duplicate_ips(static_ips):
     ipset = collections.defaultdict(list)
-    # TODO(shadower): we're doing this netsted loop multiple times. Turn it
-    # into a generator or something.
-    for role, services in six.iteritems(static_ips):
-        if not isinstance(services, collections.Mapping):
-            errors.append("The {} must be a dictionary.".format(role))
-            continue
-        for service, ips in six.iteritems(services):
-            if not isinstance(ips, collections.Iterable):
-                errors.append("The {}->{} must be a list."
-                              .format(role, service))
-                continue
-            for ip in ips:
-                ipset[ip].append((role, service))
+    for service in static_ips:
+        for ip in service.ips or ():
+            ipset[ip].append((service.role, service.service))
     for ip, sources in six.iteritems(ipset):
         if len(sources) > 1:
-            msg = "The {} IP address was entered multiple times: {}."
-            formatted_sources = ("{}[{}]".format(*source) for source in sources)
-            errors.append(msg.format(ip, ", ".join(formatted_sources)))
-    return errors
+            formatted_sources = ", ".join("{}[{}]".format(*source)
+                                          for source in sources)
+            yield ValidationError(
+                'duplicate-ip', formatted_sources,
+                "The {} IP address was entered multiple times: {}.",
+                ip, formatted_sources)
+
+
+def check_cross_site_conflicts(netenvs):
+    """Find VLAN IDs and static IPs claimed by several network environments.
+
+    This takes a list of `(path, network_data)` pairs, one for each site.
+    All the VLAN IDs go to one index and all the static IPs to another, which
+    maps every address to the `(path, role, service)` triples using it. Each
+    shared VLAN ID or address is reported once with all its users. Only
+    conflicts between different sites are reported, the checks of a single
+    network environment cover the rest.
+    """
+    return messages(cross_site_conflicts(netenvs))
+
+
+def cross_site_conflicts(netenvs):
+    vlans = collections.OrderedDict()
+    addresses = {}
+    for path, network_data in netenvs:
+        netenv = normalize_network_environment(
+            network_data.get('parameter_defaults') or {})
+        for item, data in six.iteritems(netenv.vlans):
+            if isinstance(data, Hashable):
+                vlans.setdefault(data, []).append((path, item))
+        for service in netenv.static_ips:
+            for address in service.addresses:
+                users = addresses.setdefault(address,
+                                             collections.OrderedDict())
+                users[(path, service.role, service.service)] = None
+
+    for vlan_id, users in six.iteritems(vlans):
+        if len(set(path for path, _ in users)) > 1:
+            yield ValidationError(
+                'duplicate-vlan', users[0][0],
+                "Vlan ID {} is used by several sites: {}.", vlan_id,
+                ", ".join("{}[{}]".format(*user) for user in users))
+
+    for address in sorted(addresses):
+        users = list(addresses[address])
+        if len(set(path for path, _, _ in users)) > 1:
+            yield ValidationError(
+                'duplicate-ip', users[0][0],
+                "IP address {} is used by several sites: {}.",
+                ip_address(address),
+                ", ".join("{1}[{2}] of {0}".format(*user) for user in users))
 
 
 def main():
     module = AnsibleModule(argument_spec=dict(
-        path=dict(required=True, type='str')
+        path=dict(required=True, type='str'),
+        cache_dir=dict(required=False, type='str'),
+        max_errors=dict(required=False, type='int'),
+        ignore=dict(required=False, type='list', default=[]),
+        fail_fast=dict(required=False, type='bool', default=False),
     ))
 
     netenv_path = module.params.get('path')
+    cache_dir = module.params.get('cache_dir')
+    max_errors = module.params.get('max_errors')
+    ignore = module.params.get('ignore')
+    fail_fast = module.params.get('fail_fast')
+
+    if cache_dir:
+        try:
+            cache_dir = create_cache_dir(cache_dir)
+        except OSError as e:
+            module.fail_json(msg="Can't create the cache directory '{}': {}"
+                             .format(cache_dir, e))
 
     if not os.path.isfile(netenv_path):
         module.exit_json(
@@ -416,10 +1046,12 @@ def main():
                       "File '{}' not found.".format(netenv_path)]
         )
 
-    errors = validate(netenv_path)
+    errors = list(filter_errors(
+        iter_validate(netenv_path, cache_dir, fail_fast), ignore, max_errors))
 
     if errors:
-        module.fail_json(msg="\n".join(errors))
+        module.fail_json(msg="\n".join(messages(errors)),
+                         errors=[error.as_dict() for error in errors])
     else:
         module.exit_json(msg="No errors found for the '{}' file.".format(
             netenv_path))
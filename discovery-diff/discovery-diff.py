@@ -1,44 +1,42 @@
+from __future__ import print_function
+
 import getopt
 import json
-from subprocess import Popen, PIPE
 import os
 import sys
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from validation_library import discovery_diff  # noqa: E402
 
-def hardware_data(hw_id, upenv):
-    '''Read the inspector data about the given node from Swift'''
-    p = Popen(('swift', 'download', '--output', '-', 'ironic-inspector', hw_id),
-              env=upenv, stdout=PIPE, stderr=PIPE)
-    if p.wait() == 0:
-        return json.loads(p.stdout.read())
+DEFAULT_CACHE_DIR = os.path.join('~', '.cache', 'discovery-diff')
 
 
-def all_equal(coll):
-    if len(coll) <= 1:
-        return True
-    first = coll[0]
-    for item in coll[1:]:
-        if item != first:
-            return False
-    return True
+def usage():
+    print('discovery-diff.py -i <envfile> [-c <cachedir>]')
 
 
 def main(argv):
     envfile = ''
     outputfile = 'diff-output.json'
+    cache_dir = os.path.expanduser(DEFAULT_CACHE_DIR)
     try:
-        opts, args = getopt.getopt(argv, "hi:", ["ifile="])
+        opts, args = getopt.getopt(argv, "hi:c:", ["ifile=", "cache-dir="])
     except getopt.GetoptError:
-        print 'test.py -i <envfile>'
+        usage()
         sys.exit(2)
     for opt, arg in opts:
         if opt == '-h':
-            print 'test.py -i <envfile>'
+            usage()
             sys.exit()
         elif opt in ("-i", "--ifile"):
             envfile = arg
-    print 'Input file is "', envfile
-    print 'Output file is "', outputfile
+        elif opt in ("-c", "--cache-dir"):
+            cache_dir = arg
+    print('Input file is "', envfile)
+    print('Output file is "', outputfile)
+    print('Cache directory is "', cache_dir)
 
     with open(str(envfile)) as data_file:
         env_data = json.load(data_file)
@@ -46,19 +44,24 @@ def main(argv):
     upenv = os.environ.copy()
     upenv.update(env_data)
 
-    p = Popen(('swift', 'list', 'ironic-inspector'), env=upenv, stdout=PIPE, stderr=PIPE)
-    if p.wait() != 0:
-        print "Error running `swift list ironic-inspector`"
-        print p.stderr.read()
+    # Only the objects changed since the last run are downloaded
+    store = discovery_diff.create_store(upenv, cache_dir=cache_dir)
+    try:
+        hardware_ids = store.list(discovery_diff.INSPECTOR_CONTAINER)
+    except discovery_diff.ObjectStoreError as e:
+        print(e)
         sys.exit(1)
 
-    hardware_ids = [i.strip() for i in p.stdout.read().splitlines() if i.strip()]
     hw_dicts = {}
-    for hwid in hardware_ids:
-        hw_dicts[hwid] = hardware_data(hwid, upenv)
+    results = discovery_diff.fetch_inspector_data(store, hardware_ids)
+    for hwid, (data, error) in zip(hardware_ids, results):
+        if error:
+            print(error)
+        hw_dicts[hwid] = data
 
     with open('diff-output.json', 'w') as out:
         json.dump(hw_dicts, out)
 
+
 if __name__ == "__main__":
     main(sys.argv[1:])
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+'''
+A local stand-in for the Swift object store holding the inspector data.
+
+It serves generated introspection data with a configurable latency and
+failure rate, so that downloading the data of many nodes can be measured
+without an undercloud:
+
+    $ python discovery-diff/fake_swift.py --nodes 500 --latency 0.05
+
+With --changed, the downloads are cached and repeated after changing some
+of the objects.
+'''
+
+from __future__ import print_function
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from validation_library import discovery_diff  # noqa: E402
+
+
+def generate_inspector_data(index, disks=4, nics=4):
+    '''Generate introspection data resembling the one of a real node.'''
+    return {
+        'cpus': 8,
+        'cpu_arch': 'x86_64',
+        'memory_mb': 16384,
+        'local_gb': 500,
+        'ipmi_address': '192.168.24.{}'.format(index % 250 + 1),
+        'boot_interface': '52:54:00:{:02x}:{:02x}:00'.format(
+            index // 256 % 256, index % 256),
+        'inventory': {
+            'system_vendor': {
+                'manufacturer': 'Fake',
+                'product_name': 'Node',
+                'serial_number': 'SN{:06d}'.format(index),
+            },
+            'disks': [{'name': '/dev/sd' + chr(ord('a') + disk),
+                       'size': 500107862016, 'rotational': True}
+                      for disk in range(disks)],
+            'interfaces': [{'name': 'eth{}'.format(nic),
+                            'mac_address': '52:54:00:{:02x}:{:02x}:{:02x}'
+                            .format(index // 256 % 256, index % 256, nic)}
+                           for nic in range(nics)],
+        },
+        'extra': {
+            'system': {
+                'os': {'version': 'CentOS Linux release 7.2.1511 (Core)'},
+                'kernel': {'version': '3.10.0-327.el7.x86_64'},
+            },
+            'firmware': {'bios': {'version': '1.{}'.format(index % 2)}},
+        },
+    }
+
+
+class FakeObjectStore(object):
+    '''In-memory object store with the interface of discovery_diff's stores.
+
+    Every request sleeps for `latency` seconds and fails with the probability
+    `failure_rate`.
+    '''
+
+    def __init__(self, objects, latency=0.0, failure_rate=0.0):
+        self.objects = objects
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.random = random.Random(0)
+
+    def request(self):
+        with self.lock:
+            self.requests += 1
+            failed = self.random.random() < self.failure_rate
+        time.sleep(self.latency)
+        if failed:
+            raise discovery_diff.ObjectStoreError('503 Service Unavailable')
+
+    def list_objects(self, container):
+        self.request()
+        objects = self.objects.get(container, {})
+        return [(name, hashlib.md5(objects[name]).hexdigest())
+                for name in sorted(objects)]
+
+    def list(self, container):
+        return [name for name, _ in self.list_objects(container)]
+
+    def get(self, container, name):
+        self.request()
+        try:
+            return self.objects[container][name]
+        except KeyError:
+            raise discovery_diff.ObjectStoreError('404 Not Found')
+
+
+def generate_store(nodes, **kwargs):
+    '''Create a fake store with the inspector data of `nodes` nodes.'''
+    blobs = dict(
+        ('{:08x}-0000-0000-0000-000000000000'.format(index),
+         json.dumps(generate_inspector_data(index)).encode('utf-8'))
+        for index in range(nodes))
+    return FakeObjectStore({discovery_diff.INSPECTOR_CONTAINER: blobs},
+                           **kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Inspector data download benchmark against a fake Swift')
+    parser.add_argument('--nodes', type=int, default=500,
+                        help='number of introspected nodes')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='duration of every request in seconds')
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+                        help='probability of a request failing')
+    parser.add_argument('--threads', type=int, nargs='+',
+                        default=[1, discovery_diff.FETCH_THREADS],
+                        help='thread pool sizes to compare')
+    parser.add_argument('--retries', type=int,
+                        default=discovery_diff.FETCH_RETRIES,
+                        help='number of retries of a failed download')
+    parser.add_argument('--changed', type=int, default=None,
+                        help='cache the downloads and download again after '
+                             'changing the given number of objects')
+    args = parser.parse_args()
+
+    print('{:>8} {:>8} {:>8} {:>10} {:>8} {:>12}'.format(
+        'nodes', 'threads', 'run', 'requests', 'failed', 'time [s]'))
+    for threads in args.threads:
+        fake = generate_store(args.nodes, latency=args.latency,
+                              failure_rate=args.failure_rate)
+        runs = ['cold']
+        store = fake
+        cache_dir = None
+        if args.changed is not None:
+            cache_dir = tempfile.mkdtemp()
+            store = discovery_diff.CachedStore(fake, cache_dir)
+            runs.append('warm')
+        try:
+            for run in runs:
+                if run == 'warm':
+                    blobs = fake.objects[discovery_diff.INSPECTOR_CONTAINER]
+                    for name in sorted(blobs)[:args.changed]:
+                        blobs[name] = blobs[name].replace(b'16384', b'32768')
+                fake.requests = 0
+                start = time.time()
+                hardware_ids = store.list(discovery_diff.INSPECTOR_CONTAINER)
+                results = discovery_diff.fetch_inspector_data(
+                    store, hardware_ids, threads, args.retries,
+                    retry_delay=0.01)
+                elapsed = time.time() - start
+                failed = sum(1 for _, error in results if error)
+                print('{:8d} {:8d} {:>8} {:10d} {:8d} {:12.2f}'.format(
+                    args.nodes, threads, run, fake.requests, failed,
+                    elapsed))
+        finally:
+            if cache_dir:
+                shutil.rmtree(cache_dir, ignore_errors=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,399 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import argparse
+import itertools
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import netaddr
+import yaml
+
+from validation_library import validate_network_environment as validation
+from validation_library.validate_network_environment import check_cidr_overlap
+
+SERVICES = ['internal_api', 'storage', 'storage_mgmt', 'tenant', 'external']
+
+
+def generate_networks(count):
+    """Generate `count` CIDRs, every tenth of them overlapping another one."""
+    networks = []
+    for i in range(count):
+        if i % 10 == 9:
+            # Second half of the previous network
+            i -= 1
+            networks.append('10.{}.{}.128/25'.format(i // 256 % 256, i % 256))
+        else:
+            networks.append('10.{}.{}.0/24'.format(i // 256 % 256, i % 256))
+    return networks
+
+
+def service_names(networks):
+    """The first services are the usual ones, the rest is numbered."""
+    return SERVICES[:networks] + ['extra_{}'.format(index)
+                                  for index in range(len(SERVICES), networks)]
+
+
+def generate_netenv(roles, nodes, networks=len(SERVICES), pools=1):
+    """Generate network environment data with `nodes` nodes in each role.
+
+    Every one of the `networks` services gets its own /16 network. The upper
+    half is split into `pools` allocation ranges, the static IPs of all the
+    nodes are in the lower half. The result has no errors.
+    """
+    if not 0 < pools <= 1 << 15:
+        raise ValueError('Between 1 and 32768 pools are supported')
+    if networks > 256 or roles * nodes + 10 > 1 << 15:
+        raise ValueError('Too many networks or nodes')
+    parameters = {}
+    services = service_names(networks)
+    subnets = [netaddr.IPNetwork('10.{}.0.0/16'.format(index))
+               for index in range(networks)]
+    pool_size = (1 << 15) // pools
+    for index, service in enumerate(services):
+        name = service.title().replace('_', '')
+        parameters[name + 'NetCidr'] = str(subnets[index])
+        upper_half = subnets[index].first + (1 << 15)
+        parameters[name + 'AllocationPools'] = [
+            {'start': str(netaddr.IPAddress(upper_half + pool * pool_size)),
+             'end': str(netaddr.IPAddress(
+                 upper_half + (pool + 1) * pool_size - 1))}
+            for pool in range(pools)]
+        parameters[name + 'NetworkVlanID'] = 100 + index
+    for role in range(roles):
+        parameters['Role{}IPs'.format(role)] = dict(
+            (service, [str(netaddr.IPAddress(
+                subnets[index].first + 10 + role * nodes + node))
+                for node in range(nodes)])
+            for index, service in enumerate(services))
+    return {'parameter_defaults': parameters}
+
+
+def generate_nic_config(networks=len(SERVICES)):
+    """Generate a NIC config with a bonded bridge and a VLAN per network."""
+    members = [{'type': 'ovs_bond', 'name': 'bond1',
+                'members': [{'type': 'interface', 'name': 'nic2'},
+                            {'type': 'interface', 'name': 'nic3'}]}]
+    members.extend({'type': 'vlan', 'vlan_id': 100 + index}
+                   for index in range(networks))
+    return {
+        'heat_template_version': '2015-04-30',
+        'resources': {
+            'OsNetConfigImpl': {
+                'type': 'OS::Heat::StructuredConfig',
+                'properties': {
+                    'group': 'os-apply-config',
+                    'config': {
+                        'os_net_config': {
+                            'network_config': [
+                                {'type': 'interface', 'name': 'nic1'},
+                                {'type': 'ovs_bridge', 'name': 'br-ex',
+                                 'members': members},
+                            ]
+                        }
+                    }
+                }
+            }
+        }
+    }
+
+
+def write_netenv(directory, network_data, roles, nic_config):
+    """Write the data as a network environment file with NIC configs."""
+    os.mkdir(os.path.join(directory, 'nic-configs'))
+    registry = {}
+    for role in range(roles):
+        relative_path = os.path.join('nic-configs', 'role{}.yaml'.format(role))
+        with open(os.path.join(directory, relative_path), 'w') as nic_file:
+            yaml.safe_dump(nic_config, nic_file)
+        registry['OS::TripleO::Role{}::Net::SoftwareConfig'.format(
+            role)] = relative_path
+    data = dict(network_data, resource_registry=registry)
+    netenv_path = os.path.join(directory, 'network-environment.yaml')
+    with open(netenv_path, 'w') as netenv_file:
+        yaml.safe_dump(data, netenv_file)
+    return netenv_path
+
+
+def split_parameters(parameter_defaults):
+    """Split the parameters the way validate_network_environment() does."""
+    cidrinfo = {}
+    poolsinfo = {}
+    vlaninfo = {}
+    staticipinfo = {}
+    for item, data in parameter_defaults.items():
+        if item.endswith('NetCidr'):
+            cidrinfo[item] = data
+        elif item.endswith('AllocationPools'):
+            poolsinfo[item] = data
+        elif item.endswith('NetworkVlanID'):
+            vlaninfo[item] = data
+        elif item.endswith('IPs'):
+            staticipinfo[item] = data
+    return cidrinfo, poolsinfo, vlaninfo, staticipinfo
+
+
+def separate_checks(network_data):
+    """Run the checks on the raw parameters, each one parsing them again."""
+    errors = []
+    cidrinfo, poolsinfo, vlaninfo, staticipinfo = split_parameters(
+        network_data['parameter_defaults'])
+    errors.extend(validation.check_cidr_overlap(cidrinfo.values()))
+    errors.extend(validation.check_allocation_pools_pairing(
+        network_data['parameter_defaults'], poolsinfo))
+    errors.extend(
+        validation.check_static_ip_pool_collision(staticipinfo, poolsinfo))
+    errors.extend(validation.check_vlan_ids(vlaninfo))
+    errors.extend(validation.check_static_ip_in_cidr(cidrinfo, staticipinfo))
+    errors.extend(validation.duplicate_static_ips(staticipinfo))
+    return errors
+
+
+def pairwise_cidr_overlap(networks):
+    """The former all-pairs check, kept as a reference for the benchmark."""
+    errors = []
+    objs = [netaddr.IPNetwork(x) for x in networks]
+    for net1, net2 in itertools.combinations(objs, 2):
+        if (net1 in net2 or net2 in net1):
+            errors.append(
+                'Networks {} and {} overlap.'
+                .format(net1, net2))
+    return errors
+
+
+def best_time(func, arg, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        result = func(arg)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def bench_cidr_overlap(args):
+    print('{:>10} {:>10} {:>14} {:>14}'.format(
+        'networks', 'overlaps', 'sweep [s]', 'pairwise [s]'))
+    count = args.min_networks
+    while count <= args.max_networks:
+        networks = generate_networks(count)
+        elapsed, errors = best_time(check_cidr_overlap, networks, args.repeat)
+        if count <= args.pairwise_limit:
+            pairwise, expected = best_time(pairwise_cidr_overlap, networks, 1)
+            if errors != expected:
+                print('Results differ for {} networks'.format(count))
+                return 1
+            pairwise = '{:14.4f}'.format(pairwise)
+        else:
+            pairwise = '{:>14}'.format('-')
+        print('{:10d} {:10d} {:14.4f} {}'.format(
+            count, len(errors), elapsed, pairwise))
+        count *= 10
+    return 0
+
+
+def bench_netenv(args):
+    print('{:>8} {:>8} {:>10} {:>14} {:>14} {:>14}'.format(
+        'roles', 'nodes', 'IPs', 'normalize [s]', 'validate [s]',
+        'separate [s]'))
+    nodes = args.nodes
+    while nodes <= args.max_nodes:
+        network_data = generate_netenv(args.roles, nodes)
+        normalize, _ = best_time(
+            validation.normalize_network_environment,
+            network_data['parameter_defaults'], args.repeat)
+        validate, errors = best_time(
+            lambda data: validation.validate_network_environment(data, []),
+            network_data, args.repeat)
+        separate, expected = best_time(separate_checks, network_data,
+                                       args.repeat)
+        if sorted(errors) != sorted(expected):
+            print('Results differ for {} nodes'.format(nodes))
+            return 1
+        print('{:8d} {:8d} {:10d} {:14.4f} {:14.4f} {:14.4f}'.format(
+            args.roles, nodes, args.roles * nodes * len(SERVICES),
+            normalize, validate, separate))
+        nodes *= 2
+    return 0
+
+
+def suite_checks(network_data, nic_config, netenv_path):
+    """The timed functions of the suite, in the order they are reported."""
+    parameter_defaults = network_data['parameter_defaults']
+    cidrinfo, poolsinfo, vlaninfo, staticipinfo = split_parameters(
+        parameter_defaults)
+
+    def validate_files(path):
+        # Time the parsing of the NIC configs too, not the memoised copies
+        validation.nic_config_cache.clear()
+        return validation.validate(path)
+
+    return [
+        ('check_cidr_overlap', validation.check_cidr_overlap,
+         list(cidrinfo.values())),
+        ('check_allocation_pools_pairing',
+         lambda pools: validation.check_allocation_pools_pairing(
+             parameter_defaults, pools), poolsinfo),
+        ('check_static_ip_pool_collision',
+         lambda static_ips: validation.check_static_ip_pool_collision(
+             static_ips, poolsinfo), staticipinfo),
+        ('check_vlan_ids', validation.check_vlan_ids, vlaninfo),
+        ('check_static_ip_in_cidr',
+         lambda static_ips: validation.check_static_ip_in_cidr(
+             cidrinfo, static_ips), staticipinfo),
+        ('duplicate_static_ips', validation.duplicate_static_ips,
+         staticipinfo),
+        ('check_nic_configs',
+         lambda nic_data: validation.check_nic_configs('nic.yaml', nic_data),
+         nic_config),
+        ('normalize_network_environment',
+         lambda parameters: validation.normalize_network_environment(
+             parameters).errors, parameter_defaults),
+        ('validate_network_environment',
+         lambda data: validation.validate_network_environment(data, []),
+         network_data),
+        ('validate', validate_files, netenv_path),
+    ]
+
+
+def load_baseline(path):
+    with open(path) as baseline_file:
+        return json.load(baseline_file)
+
+
+def save_baseline(path, parameters, results):
+    with open(path, 'w') as baseline_file:
+        json.dump({'parameters': parameters, 'results': results},
+                  baseline_file, indent=2, sort_keys=True)
+        baseline_file.write('\n')
+
+
+def bench_suite(args):
+    parameters = {'roles': args.roles, 'nodes': args.nodes,
+                  'networks': args.networks, 'pools': args.pools,
+                  'repeat': args.repeat}
+    baseline = None
+    if args.baseline:
+        baseline = load_baseline(args.baseline)
+        if baseline.get('parameters') != parameters:
+            print('Warning: the baseline was recorded with {}'.format(
+                baseline.get('parameters')))
+        baseline = baseline.get('results', {})
+
+    network_data = generate_netenv(args.roles, args.nodes, args.networks,
+                                   args.pools)
+    nic_config = generate_nic_config(args.networks)
+    directory = tempfile.mkdtemp()
+    try:
+        netenv_path = write_netenv(directory, network_data, args.roles,
+                                   nic_config)
+        results = {}
+        regressions = []
+        print('{:<32} {:>12} {:>12} {:>8}'.format(
+            'check', 'time [s]', 'baseline [s]', 'change'))
+        for name, func, arg in suite_checks(network_data, nic_config,
+                                            netenv_path):
+            elapsed, errors = best_time(func, arg, args.repeat)
+            if errors:
+                print('{} reported errors on the generated data: {}'.format(
+                    name, errors[:3]))
+                return 1
+            results[name] = elapsed
+            reference = baseline.get(name) if baseline else None
+            if reference:
+                change = elapsed / reference - 1
+                flag = ''
+                # Ignore the noise of the fastest checks
+                if (change > args.threshold and
+                        elapsed - reference > args.min_difference):
+                    regressions.append(name)
+                    flag = ' REGRESSION'
+                print('{:<32} {:12.4f} {:12.4f} {:+7.0%}{}'.format(
+                    name, elapsed, reference, change, flag))
+            else:
+                print('{:<32} {:12.4f} {:>12} {:>8}'.format(
+                    name, elapsed, '-', '-'))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if args.save_baseline:
+        save_baseline(args.save_baseline, parameters, results)
+        print('Baseline saved to {}'.format(args.save_baseline))
+    if regressions:
+        print('{} check(s) slower than the baseline by more than {:.0%}: {}'
+              .format(len(regressions), args.threshold,
+                      ', '.join(regressions)))
+        return 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Network environment validation benchmarks')
+    parser.add_argument('-n', '--repeat', type=int, default=3,
+                        help='number of repetitions, the best one is '
+                             'reported')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    cidr = subparsers.add_parser(
+        'cidr-overlap', help='overlap check of a growing number of networks')
+    cidr.add_argument('--min-networks', type=int, default=10,
+                      help='number of networks in the first round')
+    cidr.add_argument('--max-networks', type=int, default=10000,
+                      help='number of networks in the last round, '
+                           'multiplied by ten each round')
+    cidr.add_argument('--pairwise-limit', type=int, default=1000,
+                      help='largest round compared with the all-pairs '
+                           'check')
+    cidr.set_defaults(func=bench_cidr_overlap)
+
+    netenv = subparsers.add_parser(
+        'netenv', help='all the checks of a generated network environment')
+    netenv.add_argument('--roles', type=int, default=10,
+                        help='number of roles with static IPs')
+    netenv.add_argument('--nodes', type=int, default=25,
+                        help='number of nodes in each role in the first '
+                             'round, doubled each round')
+    netenv.add_argument('--max-nodes', type=int, default=200,
+                        help='number of nodes in each role in the last '
+                             'round')
+    netenv.set_defaults(func=bench_netenv)
+
+    suite = subparsers.add_parser(
+        'suite', help='each check and the end-to-end validation of a '
+                      'generated network environment, compared with a '
+                      'baseline')
+    suite.add_argument('--roles', type=int, default=10,
+                       help='number of roles with static IPs and NIC '
+                            'configs')
+    suite.add_argument('--nodes', type=int, default=100,
+                       help='number of nodes in each role')
+    suite.add_argument('--networks', type=int, default=len(SERVICES),
+                       help='number of networks')
+    suite.add_argument('--pools', type=int, default=1,
+                       help='number of allocation pools in each network')
+    suite.add_argument('--baseline', type=str, default=None,
+                       help='JSON file with the results to compare with')
+    suite.add_argument('--save-baseline', type=str, default=None,
+                       help='JSON file to store the results in')
+    suite.add_argument('--threshold', type=float, default=0.2,
+                       help='relative slowdown reported as a regression')
+    suite.add_argument('--min-difference', type=float, default=0.001,
+                       help='absolute slowdown in seconds below which no '
+                            'regression is reported')
+    suite.set_defaults(func=bench_suite)
+
+    args = parser.parse_args()
+
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
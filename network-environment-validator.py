@@ -1,9 +1,109 @@
 #!/usr/bin/env python
 
+from __future__ import print_function
+
 import argparse
+import glob
+import itertools
+import multiprocessing
+import os
+import shutil
 import sys
+import tempfile
+import time
+
+from validation_library.validate_network_environment import (
+    create_cache_dir, cross_site_conflicts, filter_errors,
+    iter_network_environment_errors, iter_validate, messages,
+    read_network_environment_files)
+
+
+def batch_paths(pattern):
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, '*.yaml')
+    return sorted(path for path in glob.glob(pattern)
+                  if os.path.isfile(path))
+
+
+def validate_file(task):
+    netenv_path, cache_dir, cross_site, ignore, max_errors, fail_fast = task
+    try:
+        network_data, nic_configs, errors = read_network_environment_files(
+            netenv_path, cache_dir)
+        if fail_fast and errors:
+            errors = errors[:1]
+        else:
+            errors = itertools.chain(errors, iter_network_environment_errors(
+                network_data, nic_configs, fail_fast))
+        errors = messages(filter_errors(errors, ignore, max_errors))
+    except Exception as e:
+        # A broken file must not stop the validation of the others
+        return netenv_path, ["Can't validate network environment file "
+                             "'{}': {}".format(netenv_path, e)], None
+    # Only the parameters are needed for the cross-site checks
+    if cross_site:
+        network_data = {
+            'parameter_defaults': network_data.get('parameter_defaults') or {}}
+    else:
+        network_data = None
+    return netenv_path, errors, network_data
+
 
-from validation_library.validate_network_environment import validate
+def validate_batch(pattern, jobs, cache_dir, cross_site=False, ignore=(),
+                   max_errors=None, fail_fast=False):
+    paths = batch_paths(pattern)
+    if not paths:
+        print("No network environment files match '{}'".format(pattern))
+        return 1
+
+    # The workers share the parsed NIC config templates through the cache
+    # directory, a temporary one is used when none is given.
+    tmp_dir = None
+    if cache_dir is None:
+        tmp_dir = cache_dir = tempfile.mkdtemp()
+
+    failed = 0
+    netenvs = []
+    start = time.time()
+    pool = multiprocessing.Pool(jobs)
+    try:
+        tasks = [(path, cache_dir, cross_site, ignore, max_errors, fail_fast)
+                 for path in paths]
+        for netenv_path, errors, network_data in pool.imap(validate_file,
+                                                           tasks):
+            if cross_site and network_data is not None:
+                netenvs.append((netenv_path, network_data))
+            if errors:
+                failed += 1
+                print("{}: {} error(s)".format(netenv_path, len(errors)))
+                for error in errors:
+                    print("    {}".format(error))
+            else:
+                print("{}: No errors found".format(netenv_path))
+            sys.stdout.flush()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        if tmp_dir:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    conflicts = []
+    if cross_site:
+        conflicts = messages(filter_errors(cross_site_conflicts(netenvs),
+                                           ignore, max_errors))
+        if conflicts:
+            print("Cross-site conflicts: {} error(s)".format(len(conflicts)))
+            for error in conflicts:
+                print("    {}".format(error))
+        else:
+            print("Cross-site conflicts: No errors found")
+    elapsed = time.time() - start
+
+    print("Validated {} files in {:.2f} s ({:.1f} files/sec), {} with errors"
+          .format(len(paths), elapsed, len(paths) / max(elapsed, 1e-6),
+                  failed))
+    return 1 if failed or conflicts else 0
 
 
 def main():
@@ -12,15 +112,66 @@ def main():
                         help='path to network environment file',
                         type=str,
                         default='network-environment.yaml')
+    parser.add_argument('-c', '--cache-dir',
+                        help='directory for parsed NIC config templates, '
+                             'shared with the validate_network_environment '
+                             'Ansible module',
+                        type=str,
+                        default=None)
+    parser.add_argument('-b', '--batch',
+                        help='validate all the network environment files in '
+                             'a directory or matching a glob pattern',
+                        type=str,
+                        default=None)
+    parser.add_argument('-j', '--jobs',
+                        help='number of processes for --batch',
+                        type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument('-m', '--max-errors',
+                        help='stop after the given number of errors in '
+                             'each file',
+                        type=int,
+                        default=None)
+    parser.add_argument('-i', '--ignore',
+                        help='do not report errors with the given code, '
+                             'e.g. duplicate-vlan, can be repeated',
+                        action='append',
+                        default=[])
+    parser.add_argument('-f', '--fail-fast',
+                        help='stop validating a file at its first fatal '
+                             'error, e.g. an unparseable CIDR',
+                        action='store_true')
+    parser.add_argument('-x', '--cross-site',
+                        help='with --batch, also report VLAN IDs and static '
+                             'IPs shared by several files',
+                        action='store_true')
     args = parser.parse_args()
 
-    errors = validate(args.netenv)
+    cache_dir = args.cache_dir
+    if cache_dir:
+        try:
+            cache_dir = create_cache_dir(cache_dir)
+        except OSError as e:
+            print("Can't create the cache directory '{}': {}".format(
+                cache_dir, e), file=sys.stderr)
+            return 1
 
-    if errors:
-        for error in errors:
-            print error
-    else:
-        print "No errors found"
+    if args.batch:
+        return validate_batch(args.batch, args.jobs, cache_dir,
+                              args.cross_site, args.ignore, args.max_errors,
+                              args.fail_fast)
+
+    # Print the errors as soon as they are found
+    errors = filter_errors(
+        iter_validate(args.netenv, cache_dir, args.fail_fast),
+        args.ignore, args.max_errors)
+    found = False
+    for error in errors:
+        found = True
+        print(error.message)
+        sys.stdout.flush()
+    if not found:
+        print("No errors found")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+''' Benchmarks for reference_validator.
+
+    parse  - YAML parse throughput of the pure Python and the libyaml loader
+    lookup - reference checks of templates with growing number of resources and references
+'''
+
+from __future__ import with_statement, print_function
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import yaml  # pip install pyyaml
+
+import reference_validator
+
+# Template used by every tenth resource in synthetic templates with nested resources
+NESTED_TEMPLATE = '''heat_template_version: 2015-04-30
+parameters:
+  Input: {type: string, default: value}
+resources:
+  Config: {type: OS::Heat::None}
+outputs:
+  result: {value: {get_attr: [Config, value]}}
+'''
+
+
+def synthetic_template(resources, references=1, nested=None):
+    ''' Generates HOT template with given number of resources, returns its text.
+        resources  - number of resources (and parameters)
+        references - number of get_resource/get_param/get_attr triples in each resource
+        nested     - path of template used by every tenth resource
+    '''
+    lines = ['heat_template_version: 2015-04-30', 'parameters:']
+    for i in range(resources):
+        lines.append('  Param%d: {type: string, default: value%d}' % (i, i))
+    lines.append('resources:')
+    for i in range(resources):
+        if nested and i % 10 == 0:
+            lines.extend(['  Resource%d:' % i,
+                          '    type: ' + nested,
+                          '    properties:',
+                          '      Input: {get_param: Param%d}' % i])
+            continue
+        lines.extend(['  Resource%d:' % i,
+                      '    type: OS::Heat::StructuredConfig',
+                      '    properties:',
+                      '      group: os-apply-config',
+                      '      config:',
+                      '        key%d:' % i,
+                      '          list_join:',
+                      "          - ','",
+                      '          - - {get_param: Param%d}' % i,
+                      '            - {get_resource: Resource%d}' % ((i + 1) % resources)])
+        for j in range(1, references):
+            target = (i + j * 7) % resources
+            attr = 'result' if nested and target % 10 == 0 else 'config'
+            lines.extend(['            - {get_param: Param%d}' % ((i + j) % resources),
+                          '            - {get_resource: Resource%d}' % target,
+                          '            - {get_attr: [Resource%d, %s]}' % (target, attr)])
+    lines.append('outputs:')
+    for i in range(resources):
+        lines.append('  out%d: {value: {get_attr: [Resource%d, config]}}' % (i, i))
+    return '\n'.join(lines) + '\n'
+
+
+def measure(loader, documents, repeat):
+    ''' Returns the best time of parsing all documents with loader. '''
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        for doc in documents:
+            yaml.load(doc, Loader=loader)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def bench_parse(args):
+    ''' Prints parse throughput in MB/s for every available loader. '''
+    if args.files:
+        documents = []
+        for path in args.files:
+            with open(path, 'rb') as fd:
+                documents.append(fd.read())
+    else:
+        documents = [synthetic_template(args.resources).encode('utf-8')]
+
+    size = sum(len(doc) for doc in documents)
+    print('Input: %d file(s), %.2f MB' % (len(documents), size / 1e6))
+
+    loaders = [('SafeLoader (pure Python)', yaml.SafeLoader)]
+    if hasattr(yaml, 'CSafeLoader'):
+        loaders.append(('CSafeLoader (libyaml)', yaml.CSafeLoader))
+    else:
+        print('libyaml bindings are not available, only the pure Python loader is measured.')
+
+    for name, loader in loaders:
+        elapsed = measure(loader, documents, args.repeat)
+        print('%-26s %8.3f s %8.2f MB/s' % (name, elapsed, size / 1e6 / elapsed))
+
+
+def bench_lookup(args):
+    ''' Prints time of reference checks for growing templates, parsing is excluded. '''
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(tmp_dir, 'nested.yaml'), 'w') as fd:
+            fd.write(NESTED_TEMPLATE)
+
+        print('%10s %10s %10s' % ('resources', 'references', 'check [s]'))
+        resources = args.resources
+        while resources <= args.max_resources:
+            path = os.path.join(tmp_dir, 'template%d.yaml' % resources)
+            with open(path, 'w') as fd:
+                fd.write(synthetic_template(resources, args.references, 'nested.yaml'))
+
+            # Warm up the cache so only the reference checks are measured
+            cache = reference_validator.YAML_HotValidator.YAML_Cache()
+            cache.load(path)
+            cache.load(os.path.join(tmp_dir, 'nested.yaml'))
+
+            best = None
+            for _ in range(args.repeat):
+                root = reference_validator.YAML_HotValidator.YAML_Hotfile(None, path)
+                start = time.time()
+                root.validate_file([], [root], [], tmp_dir, cache)
+                elapsed = time.time() - start
+                if best is None or elapsed < best:
+                    best = elapsed
+
+            print('%10d %10d %10.3f' % (resources, resources * args.references * 3, best))
+            resources *= 2
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def main():
+
+    # Parse arguments
+    parser = argparse.ArgumentParser(description='reference_validator benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    parse = subparsers.add_parser('parse', help='YAML parse throughput.')
+    parse.add_argument('files', metavar='path/to/file', nargs='*',
+                       help='YAML files to be parsed, synthetic template is used when omitted.')
+    parse.add_argument('-r', '--resources', type=int, default=2000,
+                       help='Number of resources in synthetic template.')
+    parse.add_argument('-n', '--repeat', type=int, default=3,
+                       help='Number of repetitions, the best one is reported.')
+    parse.set_defaults(func=bench_parse)
+
+    lookup = subparsers.add_parser('lookup', help='Reference checks of growing templates.')
+    lookup.add_argument('-r', '--resources', type=int, default=250,
+                        help='Number of resources in the smallest template, doubled up to --max-resources.')
+    lookup.add_argument('-m', '--max-resources', type=int, default=4000,
+                        help='Number of resources in the largest template.')
+    lookup.add_argument('-x', '--references', type=int, default=4,
+                        help='Number of reference triples in each resource.')
+    lookup.add_argument('-n', '--repeat', type=int, default=3,
+                        help='Number of repetitions, the best one is reported.')
+    lookup.set_defaults(func=bench_lookup)
+
+    args = parser.parse_args()
+    args.func(args)
+
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
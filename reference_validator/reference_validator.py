@@ -4,13 +4,35 @@
 from __future__ import with_statement, print_function
 
 import argparse
+import collections
+import fnmatch
+import hashlib
+import json
+import multiprocessing
 import os
+import pickle
 import pprint
 import re
 import sys
+import time
 import six  # compatibility
 import yaml # pip install pyyaml
 
+# Stamp of files in the persistent parse cache, bump when the stored structure changes
+CACHE_VERSION = (1, yaml.__version__)
+
+# libyaml based loader is several times faster, pure Python one is the fallback
+try:
+    YAML_Loader = yaml.CSafeLoader
+except AttributeError:
+    YAML_Loader = yaml.SafeLoader
+
+
+def load_yaml(stream):
+    ''' Parses YAML document with the fastest available safe loader. '''
+    return yaml.load(stream, Loader=YAML_Loader)
+
+
 class YAML_colours:
         ''' Code for colouring output '''
         BLUE      = '\033[94m'
@@ -22,19 +44,49 @@ class YAML_colours:
         UNDERLINE = '\033[4m'
         DEFAULT   = '\033[0m'
 
+
+class YAML_Output:
+    ''' Writes records in json (array) or jsonl (line per record) format, shared by
+        all validators writing to standard output
+    '''
+    def __init__(self, output_format):
+        self.format = output_format
+        self.records = 0
+
+    def write(self, record):
+        if self.format == 'json':
+            sys.stdout.write(('[\n' if not self.records else ',\n') + json.dumps(record, sort_keys=True))
+        else:
+            sys.stdout.write(json.dumps(record, sort_keys=True) + '\n')
+        sys.stdout.flush()
+        self.records += 1
+
+    def close(self):
+        ''' Finishes json array '''
+        if self.format == 'json':
+            sys.stdout.write('[\n]\n' if not self.records else '\n]\n')
+
+
 class YAML_HotValidator:
     ''' Detects unused variables, invalid references.'''
 
-    def __init__(self, arguments):
+    # Phases of findings of HOT files
+    REFERENCES = 1  # known once the file is validated
+    PROPERTIES = 2  # known once the whole tree is validated
+
+    def __init__(self, arguments, cache=None, output=None):
         ''' Finds *.yaml files based on entered arguments.
             arguments - dictionary with parsed arguments and their values
+            cache     - YAML_Cache to be reused, new one is created when omitted
+            output    - YAML_Output to be reused, new one is created when omitted
         '''
 
         # in environments, mappings, templates: all nodes with references to parent/children
         # in curr_nodes: currently validated nodes (DFS - depth-first search)
 
-        # Save initial directory
+        # Save initial directory and time
         self.init_dir = os.getcwd()
+        self.start_time = time.time()
 
         # List of YAML files to be checked + referenced children nodes
         self.environments = []
@@ -44,17 +96,29 @@ class YAML_HotValidator:
         # Currently opened nodes
         self.curr_nodes = []
 
+        # Parsed YAML files shared by all nodes
+        self.cache = cache if cache is not None else self.YAML_Cache(arguments['cache_dir'])
+
         # Applied parameters
+        self.arguments = arguments
         self.print_unused = arguments['unused']
         self.pretty_format = arguments['pretty_format']
+        self.print_stats = arguments['stats']
+        self.output_format = arguments['format']
+        self.output = output if output is not None else YAML_Output(self.output_format)
+        self.job = arguments.get('job')     # name of batch job
         self.printer = pprint.PrettyPrinter(indent=2)
 
+        # Number of files and findings streamed in json/jsonl format
+        self.files = 0
+        self.findings = 0
+
         # Check HOT file (-f)
         abs_path = os.path.abspath(arguments['file'])
         if abs_path.endswith('yaml'):
             self.templates.insert(0, self.YAML_Hotfile(None, abs_path))
         else:
-            print('Wrong template file suffix (YAML expected).')
+            print('Wrong template file suffix (YAML expected).', file=sys.stderr)
             sys.exit(1)
 
         # Check environment files (-e)
@@ -71,12 +135,113 @@ class YAML_HotValidator:
         ATTRIBUTE = 3 # get_attr
         PROPERTY  = 4 # parameter in file B does not have corresponding property in file A
 
+        # Intrinsic functions referring to other instances
+        FUNCTIONS = {'get_resource': RESOURCE,
+                     'get_param': PARAMETER,
+                     'get_attr': ATTRIBUTE}
+
+    class YAML_Cache:
+        ''' Parsed structures of YAML files, each file is parsed only once per run.
+            With cache_dir set, structures are also stored on disk by content hash
+            and reused by following runs.
+        '''
+
+        def __init__(self, cache_dir=None):
+            self.structures = {}        # (absolute path, mtime, size) : structure
+            self.references = {}        # (absolute path, mtime, size) : extracted references
+            self.keys = {}              # absolute path : current key in structures
+            self.cache_dir = cache_dir
+            self.hits = 0
+            self.misses = 0
+            self.disk_hits = 0          # misses served from cache_dir without parsing
+
+            if self.cache_dir and not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+
+        def load(self, path):
+            ''' Returns parsed structure of YAML file, parses it only on the first request.
+                path - path to YAML file
+            '''
+            abs_path = os.path.abspath(path)
+            stat = os.stat(abs_path)
+            key = (abs_path, stat.st_mtime, stat.st_size)
+
+            if key in self.structures:
+                self.hits += 1
+            else:
+                with open(abs_path, 'rb') as fd:
+                    content = fd.read()
+                self.structures[key] = self.load_content(content)
+                self.misses += 1
+
+                # Forget the previous version of a changed file
+                old_key = self.keys.get(abs_path)
+                if old_key is not None:
+                    del self.structures[old_key]
+                    self.references.pop(old_key, None)
+                self.keys[abs_path] = key
+
+            return self.structures[key]
+
+        def load_references(self, path):
+            ''' Returns references extracted from already loaded YAML file, the file is walked
+                only on the first request.
+                path - absolute path of YAML file
+            '''
+            key = self.keys[path]
+            if key not in self.references:
+                variables = []
+                for section, instances in six.iteritems(self.structures[key]):
+                    # skip those without nested structures
+                    if type(instances) == dict:
+
+                        # Collect instances (variables)
+                        variables.extend(six.iteritems(instances))
+
+                self.references[key] = YAML_HotValidator.YAML_Hotfile.extract_references(variables)
+
+            return self.references[key]
+
+        def load_content(self, content):
+            ''' Parses content of YAML file, or loads its structure from cache_dir.
+                content - raw content of YAML file
+            '''
+            if not self.cache_dir:
+                return load_yaml(content)
+
+            cache_path = os.path.join(self.cache_dir,
+                                      hashlib.sha1(content).hexdigest() + '.pickle')
+            try:
+                with open(cache_path, 'rb') as fd:
+                    version, structure = pickle.load(fd)
+                if version == CACHE_VERSION:
+                    self.disk_hits += 1
+                    return structure
+            except Exception:
+                # Missing, outdated or corrupted cache file, parse again
+                pass
+
+            structure = load_yaml(content)
+
+            # Write to a temporary file first, concurrent runs never see partial files
+            try:
+                tmp_path = cache_path + '.' + str(os.getpid())
+                with open(tmp_path, 'wb') as fd:
+                    pickle.dump((CACHE_VERSION, structure), fd, pickle.HIGHEST_PROTOCOL)
+                os.rename(tmp_path, cache_path)
+            except (IOError, OSError):
+                pass
+
+            return structure
+
     class YAML_Hotfile:
         ''' Class with attributes needed for work with HOT files '''
 
         def __init__(self, parent_node, abs_path):
             ''' Node is initiated when being detected '''
             self.path = abs_path
+            self.abs_path = None        # set once the file is opened
+            self.curr_path = None       # directory the path is relative to
 
             self.parent = parent_node   # Parent node or nothing in the case of root node
             self.children = []          # Ordered children - by the moment of appearance in the code
@@ -85,23 +250,28 @@ class YAML_HotValidator:
             self.params = {}            # name : used
             self.outputs = []           # name
 
+            self.resource_index = {}    # name : YAML_Resource
+            self.child_index = {}       # path : first child node with the path
+
             self.structure = {}         # structure of YAML file
             self.ok = True
 
             self.invalid = []           # list of invalid references (YAML_Reference)
+            self.references = []        # (YAML_Types, referred variable, name of referring instance)
 
-        def validate_file(self, curr_nodes, templates, environments, curr_path):
-            ''' Validates YAML file'''
+        def validate_file(self, curr_nodes, templates, environments, curr_path, cache, report=None):
+            ''' Validates YAML file, report is called with every node once it is validated '''
 
             # Add current node at the beginning
             curr_nodes.insert(0, self)
 
             # Open file
+            self.curr_path = curr_path
+            self.abs_path = os.path.abspath(os.path.join(curr_path, self.path))
             try:
-                with open(os.path.join(curr_path, self.path), 'r') as fd:
-                    self.structure = yaml.load(fd.read())
-            except IOError:
-                print('File ' + self.path + ' could not be opened.')
+                self.structure = cache.load(self.abs_path)
+            except (IOError, OSError):
+                print('File ' + self.path + ' could not be opened.', file=sys.stderr)
                 sys.exit(1)
 
             # Save all parameters names and resources + properties
@@ -120,6 +290,10 @@ class YAML_HotValidator:
                 for out in self.structure['outputs']:
                     self.outputs.append(out)
 
+            # Index resources by name for reference checks
+            for resource in self.resources:
+                self.resource_index[resource.name] = resource
+
             # Examine children nodes to get the full information about references
             for resource in self.resources:
                 if resource.type.endswith('.yaml'):
@@ -131,43 +305,95 @@ class YAML_HotValidator:
 
                     # Start validating child
                     templates[0].validate_file(curr_nodes, templates, environments,
-                                               os.path.join(curr_path, os.path.dirname(self.path)))
+                                               os.path.join(curr_path, os.path.dirname(self.path)),
+                                               cache, report)
 
                     # Whole subtree with root = current node is validated
 
-            # Iterate over sections (all children validated by now)
-            for section, instances in six.iteritems(self.structure):
-                # skip those without nested structures
-                if type(instances) == dict:
+            # Index children by path, the first one is used as in the order of appearance
+            for child in self.children:
+                if child.path not in self.child_index:
+                    self.child_index[child.path] = child
 
-                    # Iterate over instances (variables)
-                    for variable, properties in six.iteritems(instances):
-                        self.inspect_instances(properties, variable)
+            # Check references of all sections (all children validated by now), each file
+            # is walked once, all checks use the extracted references
+            self.references = cache.load_references(self.abs_path)
+            self.check_references()
 
             # Remove node from current nodes after validation
             curr_nodes.remove(self)
 
+            if report is not None:
+                report(self)
+
+        @staticmethod
+        def extract_references(variables):
+            ''' Returns references in order of appearance, walks nested structures with
+                an explicit stack instead of recursion.
+                variables - list of (name of referring instance, structure with its properties)
+            '''
+            references = []
+            functions = YAML_HotValidator.YAML_Types.FUNCTIONS
+            nested = (dict, list)
+
+            for name, properties in variables:
+                # Stack holds structures to be walked and found references (tuples, which
+                # are never produced by the YAML loader)
+                stack = [properties]
+                while stack:
+                    value = stack.pop()
+                    if type(value) == tuple:
+                        references.append(value)
+
+                    # Push in reverse order, items are popped in order of appearance
+                    elif isinstance(value, dict):
+                        items = []
+                        for key, item in value.items():
+                            if key in functions:
+                                items.append((functions[key], item, name))
+                            elif isinstance(item, nested):
+                                items.append(item)
+                        items.reverse()
+                        stack.extend(items)
+                    elif isinstance(value, list):
+                        stack.extend([x for x in reversed(value) if isinstance(x, nested)])
+
+            return references
+
+        def check_references(self):
+            ''' Check all extracted references, mark used variables '''
+            for kind, value, name in self.references:
+                self.check_validity(value, name, kind)
+
+        def recheck_references(self):
+            ''' Forget results of previous checks and check extracted references again '''
+            self.invalid = []
+            self.ok = True
+            for par in self.params:
+                self.params[par] = False
+            for resource in self.resources:
+                resource.used = False
+            self.check_references()
+
         def inspect_instances(self, properties, name):
             ''' Check if all references to variables are valid.
                 properties - structures containing instance properties and their values
                 name       - name of referring instance
             '''
-            if isinstance(properties, list):
-                for element in properties:
-                    if isinstance(element, dict) or isinstance(element, list):
-                        self.inspect_instances(element, name)
-            elif isinstance(properties, dict):
-                # Check references, mark used variables
-                for key, value in six.iteritems(properties):
-                    if key == 'get_param':
-                        self.check_validity(value, name, YAML_HotValidator.YAML_Types.PARAMETER)
-                    elif key == 'get_resource':
-                        self.check_validity(value, name, YAML_HotValidator.YAML_Types.RESOURCE)
-                    elif key == 'get_attr':
-                        self.check_validity(value, name, YAML_HotValidator.YAML_Types.ATTRIBUTE)
-                    else:
-                        self.inspect_instances(value, name)
+            for kind, value, ref_name in self.extract_references([(name, properties)]):
+                self.check_validity(value, ref_name, kind)
+
 
+        @staticmethod
+        def find(index, key):
+            ''' Returns indexed item or None, unhashable keys (nested functions) are never found.
+                index - dictionary with indexed items
+                key   - searched key
+            '''
+            try:
+                return index.get(key)
+            except TypeError:
+                return None
 
         def check_validity(self, value, name, section):
             ''' Check if all declared variables have been used.
@@ -178,16 +404,14 @@ class YAML_HotValidator:
 
             # Resource
             if section == YAML_HotValidator.YAML_Types.RESOURCE:
-                if value not in [x.name for x in self.resources]:
+                resource = self.find(self.resource_index, value)
+                if resource is None:
                     # Add it to invalid references
                     self.invalid.append(YAML_HotValidator.YAML_Reference(value, name,
                                         YAML_HotValidator.YAML_Types.RESOURCE, None))
                     self.ok = False
                 else:
-                    for resource in self.resources:
-                        if value == resource.name:
-                            resource.used = True
-                            break
+                    resource.used = True
 
             # Parameter
             elif section == YAML_HotValidator.YAML_Types.PARAMETER:
@@ -210,7 +434,7 @@ class YAML_HotValidator:
                 else:
                     # Check if it is a pseudoparameter
                     if value not in ['OS::stack_name', 'OS::stack_id', 'OS::project_id']:
-                        if value not in list(self.params.keys()):
+                        if self.find(self.params, value) is None:
 
                             # Add it to invalid references
                             self.invalid.append(YAML_HotValidator.YAML_Reference(value, name,
@@ -233,35 +457,31 @@ class YAML_HotValidator:
             ''' When access path to variable entered, check validity of hierarchy of output.
                 hierarchy - list of keys used for accessing value
             '''
-            if hierarchy[0] not in [x.name for x in self.resources]:
+            r = self.find(self.resource_index, hierarchy[0])
+            if r is None:
                 return (False, hierarchy[0])
 
             # if it is in a children node, check its first level of hierarchy
-            elif [True for x in self.resources if (x.name == hierarchy[0])
-                                                  and x.type.endswith('.yaml')]:
+            elif r.type.endswith('.yaml'):
                 flag = False
-                for r in self.resources:
-                    if r.name == hierarchy[0]:
-                        for f in self.children:
-                            if r.type == f.path:
-
-                                # outputs_list used in case of autoscaling group TODO ASG x RG
-                                if ((len(hierarchy) >= 3) and r.isGroup and
-                                    (hierarchy[1] == 'outputs_list') and
-                                    (hierarchy[2] in f.outputs)):
-                                    flag = True
-
-                                # mapped to outputs
-                                elif ((len(hierarchy) >= 2) and (hierarchy[1] in f.outputs)):
-                                    flag = True
-
-                                #resource.<name> used
-                                elif ((len(hierarchy) >= 2) and hierarchy[1].startswith('resource.')):
-                                    string = hierarchy[1].split('.')
-                                    if string[1] in [x.name for x in f.resources]:
-                                        flag = True
-                                break
-                        break
+                f = self.child_index.get(r.type)
+                if f is not None:
+
+                    # outputs_list used in case of autoscaling group TODO ASG x RG
+                    if ((len(hierarchy) >= 3) and r.isGroup and
+                        (hierarchy[1] == 'outputs_list') and
+                        (hierarchy[2] in f.outputs)):
+                        flag = True
+
+                    # mapped to outputs
+                    elif ((len(hierarchy) >= 2) and (hierarchy[1] in f.outputs)):
+                        flag = True
+
+                    #resource.<name> used
+                    elif ((len(hierarchy) >= 2) and hierarchy[1].startswith('resource.')):
+                        string = hierarchy[1].split('.')
+                        if string[1] in f.resource_index:
+                            flag = True
                 if not flag:
                     return (False, hierarchy[0])
 
@@ -292,7 +512,6 @@ class YAML_HotValidator:
                 else:
                     # TODO somehow get the result of get_X, path in structure or smth
                     self.inspect_instances(ele, name)
-                    print (ele)
             return (True, None)
 
 
@@ -302,10 +521,10 @@ class YAML_HotValidator:
             # Check if parameters have default or value from props
             for par in self.params.keys():
                 flag = False
-                if ((par not in resource.properties.keys()) and
+                if ((par not in resource.properties) and
                     (not 'default' in self.structure['parameters'][par])):
                     for env in environments:
-                        if par in list(env.params_default.keys()):
+                        if par in env.params_default:
                             env.params_default[par] = True
                             flag = True
                 else:
@@ -318,7 +537,7 @@ class YAML_HotValidator:
     
             # Check used properties
             for prop in resource.properties.keys():
-                if prop in self.params.keys():
+                if prop in self.params:
                     resource.properties[prop] = True
 
 
@@ -332,15 +551,71 @@ class YAML_HotValidator:
             self.parent = parent_node
             self.children = []
 
-            self.resource_registry = {} # original type: mapped type [, resource]
-            self.params = {}            # additional parameters, only for root file -f
-            self.params_default = {}    # default values, can replace property in property>param anywhere
+            self.resource_registry = {}  # original type (may contain wildcards): mapped type
+            self.resource_mappings = {}  # (resource, original type): mapped type
+            self.params = {}             # additional parameters, only for root file -f
+            self.params_default = {}     # default values, can replace property in property>param anywhere
 
             self.structure = {}
             self.invalid = []           # invalid parameter references
 
             self.ok = True
 
+    class YAML_Registry:
+        ''' Resolves resource types to mapped HOT files of all environments.
+            Resource specific mappings take precedence over exact type mappings, wildcard
+            mappings are used last. Environments given later on the command line win.
+        '''
+
+        def __init__(self, environments):
+            ''' environments - YAML_Env nodes ordered by priority '''
+            self.resources = {}         # (resource, type) : mapped node
+            self.types = {}             # type : mapped node
+            self.patterns = []          # mapped node of each group in matcher
+            self.matcher = None         # wildcard types compiled into a single regexp
+
+            expressions = []
+            for env in environments:
+                nodes = {}
+                for child in env.children:
+                    nodes.setdefault(child.path, child)
+
+                for key, mapped in six.iteritems(env.resource_mappings):
+                    self.resources.setdefault(key, nodes.get(mapped))
+
+                # Longer patterns are more specific
+                wildcards = []
+                for origin, mapped in six.iteritems(env.resource_registry):
+                    if '*' in origin or '?' in origin:
+                        wildcards.append((origin, nodes.get(mapped)))
+                    else:
+                        self.types.setdefault(origin, nodes.get(mapped))
+
+                # Older fnmatch.translate names its own groups g0, g1, ... for several '*'
+                for origin, node in sorted(wildcards, key=lambda x: -len(x[0])):
+                    expressions.append('(?P<_rv%d>%s)' % (len(self.patterns), fnmatch.translate(origin)))
+                    self.patterns.append(node)
+
+            if expressions:
+                self.matcher = re.compile('|'.join(expressions))
+
+        def lookup(self, resource):
+            ''' Returns HOT file node mapped to resource, None if there is no such file
+                resource - YAML_Resource
+            '''
+            key = (resource.name, resource.type)
+            if key in self.resources:
+                return self.resources[key]
+            if resource.type in self.types:
+                return self.types[resource.type]
+
+            if self.matcher is not None:
+                match = self.matcher.match(resource.type)
+                if match is not None:
+                    return self.patterns[int(match.lastgroup[3:])]
+
+            return None
+
     class YAML_Resource:
         ''' Stores useful info about resource, its structure '''
         def __init__(self, name, resource_struct):
@@ -390,24 +665,24 @@ class YAML_HotValidator:
 
         for env_node in self.environments:
             try:
-                with open(env_node.path, 'r') as fd:
-                    env_node.structure = yaml.load(fd.read())
-            except IOError:
-                print('File ' + env_node.path + ' could not be opened.')
+                env_node.structure = self.cache.load(env_node.path)
+            except (IOError, OSError):
+                print('File ' + env_node.path + ' could not be opened.', file=sys.stderr)
                 sys.exit(1)
 
             # Save mappings
             if 'resource_registry' in env_node.structure:
                 for origin, custom in six.iteritems(env_node.structure['resource_registry']):
-                    if type(custom) == str:
+                    if isinstance(custom, six.string_types):
                         env_node.resource_registry[origin] = custom
-                    elif origin == 'resources':
-                        # Find if there is any mapping (hooks etc are not important)                        
-                        for res in env_node.structure['resource_registry']['resources'].keys():
-                            for key, value in six.iteritems(env_node.structure['resource_registry']['resources'][res]):
-                                # Add indirect mapping using regexp - multiple indentations
-                                if (type(value) == str) and (value.endswith('.yaml')):
-                                    env_code.resource_registry[key] = [value, res]
+                    elif origin == 'resources' and isinstance(custom, dict):
+                        # Find if there is any mapping (hooks etc are not important)
+                        for res, mappings in six.iteritems(custom):
+                            if not isinstance(mappings, dict):
+                                continue
+                            for key, value in six.iteritems(mappings):
+                                if isinstance(value, six.string_types) and value.endswith('.yaml'):
+                                    env_node.resource_mappings[(res, key)] = value
 
             # Save additional parameters + parameters with default values
             if 'parameters' in env_node.structure:
@@ -418,10 +693,10 @@ class YAML_HotValidator:
                 for par in list(env_node.structure['parameter_defaults'].keys()):
                     env_node.params_default[par] = False
 
-            # Create HOT files with mapped files - TODO regexp mapping
-            for child in list(env_node.resource_registry.values()):
-                if ((type(child) == str and child.endswith('.yaml')) or
-                    ((type(child) == list) and child[0].endswith('.yaml'))):
+            # Create HOT files with mapped files, wildcard mappings are resolved in load_mappings
+            for child in (list(env_node.resource_registry.values()) +
+                          list(env_node.resource_mappings.values())):
+                if child.endswith('.yaml'):
 
                     # Is a file is created already as a root, no need for redundancy
                     found = False
@@ -436,31 +711,399 @@ class YAML_HotValidator:
                         self.mappings.append(env_node.children[0])
 
     def load_mappings(self):
-        ''' Add all files mapped to resources as children in parent node '''
+        ''' Add all files mapped to resources as children in parent node.
+            Mapped files are already parsed through the cache, only nodes are linked here.
+        '''
+
+        # All registries compiled once, each resource is resolved by a single lookup
+        registry = self.YAML_Registry(self.environments)
 
         for hot in self.templates + self.mappings:
             for res in hot.resources:
 
-                # If a mapped file exists
-                flag = False
-                for env in self.environments:
-                    for origin, mapped in six.iteritems(env.resource_registry):
-
-                        # Finds mapped file if the mapping is designated for the resource
-                        if (res.type == origin) and ((type(mapped) == str) or (mapped[1] == res.name)):
-
-                            # Assign it to resource
-                            for m in self.mappings:
-                                if (((type(mapped) == str) and (m.path == mapped)) or
-                                    ((type(mapped) == list) and (m.path == mapped[0]))
-                                    and (m.parent == env)):
-                                    res.child = m
-                                    flag = True
-                                    break
-                        if flag:
-                            break
-                    if flag:
-                        break
+                # If a mapped file exists, assign it to resource
+                mapped = registry.lookup(res)
+                if mapped is not None:
+                    res.child = mapped
+
+    def run(self, jobs=1):
+        ''' Loads environments, validates all files and their relations.
+            jobs - number of processes validating independent subtrees
+        '''
+
+        # Load environments to get mappings
+        self.load_environments()
+
+        # Stream findings of each file once it is validated
+        report = self.report_file if self.output_format != 'text' else None
+
+        if jobs > 1:
+            # Validate mapped HOTs and -f in independent processes
+            self.validate_parallel(jobs, report)
+        else:
+            # Validate HOTs in mappings
+            # All mappings are at the beginning, followed by children nodes
+            for hot in list(reversed(self.mappings)):
+                if hot.parent in self.environments:
+                    hot.validate_file(self.curr_nodes, self.mappings,
+                                      self.environments, os.path.join(self.init_dir,
+                                      os.path.dirname(hot.parent.path)), self.cache, report)
+                else:
+                    break
+
+            # Validate HOTs: change to its directory, validate -f
+            self.templates[0].validate_file(self.curr_nodes, self.templates,
+                                            self.environments,
+                                            os.path.join(self.init_dir,
+                                            os.path.dirname(self.templates[0].path)),
+                                            self.cache, report)
+
+        self.validate_tree()
+
+    def validate_tree(self):
+        ''' Checks relations between already validated files '''
+
+        # Also add mapped files as children once there is a full structure of files
+        self.load_mappings()
+
+        # Check environment parameters against fully loaded HOT structure
+        self.validate_env_params()
+
+        # Check properties x parameters
+        self.validate_properties(self.templates[-1])
+
+        for hot in list(reversed(self.mappings)):
+            if hot.parent in self.environments:
+                self.validate_properties(hot)
+
+    def reset_tree(self):
+        ''' Forgets results of validate_tree, so it can be run again '''
+        for env in self.environments:
+            env.ok = True
+            for par in env.params:
+                env.params[par] = False
+            for par in env.params_default:
+                env.params_default[par] = False
+
+        for hot in self.templates + self.mappings:
+            hot.invalid = [x for x in hot.invalid if x.type != self.YAML_Types.PROPERTY]
+            hot.ok = not hot.invalid
+            for res in hot.resources:
+                for prop in res.properties:
+                    res.properties[prop] = False
+
+    def revalidate(self, changed):
+        ''' Validates changed HOT files again, together with their ancestors.
+            Files which are not changed keep their results, only relations between
+            files are checked again.
+            changed - set of absolute paths of changed files
+        '''
+        nodes = self.templates + self.mappings
+
+        # Changed subtrees, nested changed files are validated with their ancestor
+        roots = []
+        for node in nodes:
+            parent = node.parent
+            while isinstance(parent, self.YAML_Hotfile) and parent.abs_path not in changed:
+                parent = parent.parent
+            if node.abs_path in changed and not isinstance(parent, self.YAML_Hotfile):
+                roots.append(node)
+
+        for root in roots:
+            nodes = self.templates if root in self.templates else self.mappings
+
+            # Drop the old subtree, the node itself stays referenced by its parent
+            old = set()
+            stack = list(root.children)
+            while stack:
+                child = stack.pop()
+                old.add(id(child))
+                stack.extend(child.children)
+            nodes[:] = [x for x in nodes if id(x) not in old]
+
+            # Validate the file with a new subtree
+            subtree = [root]
+            curr_path = root.curr_path
+            root.__init__(root.parent, root.path)
+            root.validate_file([], subtree, [], curr_path, self.cache)
+            index = nodes.index(root)
+            nodes[index:index] = subtree[:-1]
+
+            # Ancestors refer to outputs and resources of the file
+            parent = root.parent
+            while isinstance(parent, self.YAML_Hotfile):
+                parent.recheck_references()
+                parent = parent.parent
+
+        self.reset_tree()
+        self.validate_tree()
+
+    def hot_findings(self, node, phase):
+        ''' Yields findings of HOT file as dictionaries.
+            node  - validated YAML_Hotfile
+            phase - REFERENCES (known once the file is validated) or
+                    PROPERTIES (known once the whole tree is validated)
+        '''
+        name = os.path.relpath(node.abs_path, self.init_dir)
+        types = {self.YAML_Types.RESOURCE: 'resource',
+                 self.YAML_Types.PARAMETER: 'parameter',
+                 self.YAML_Types.ATTRIBUTE: 'attribute'}
+
+        if phase == self.REFERENCES:
+            for ref in [x for x in node.invalid if x.type in types]:
+                yield {'record': 'finding', 'file': name, 'finding': 'invalid_reference',
+                       'type': types[ref.type], 'name': ref.referent, 'instance': ref.element}
+
+            if self.print_unused:
+                for par in [x for x in node.params if not node.params[x]]:
+                    yield {'record': 'finding', 'file': name, 'finding': 'unused_parameter',
+                           'type': 'parameter', 'name': par}
+                for res in [x for x in node.resources if not x.used]:
+                    yield {'record': 'finding', 'file': name, 'finding': 'unused_resource',
+                           'name': res.name, 'resource_type': res.type}
+        else:
+            for ref in [x for x in node.invalid if x.type == self.YAML_Types.PROPERTY]:
+                yield {'record': 'finding', 'file': name, 'finding': 'property_mismatch',
+                       'type': 'parameter_without_property', 'name': ref.referent,
+                       'instance': ref.element, 'parent': os.path.relpath(ref.parent, self.init_dir)}
+
+            for res in [x for x in node.resources if x.type.endswith('.yaml')]:
+                for prop in [x for x in res.properties if not res.properties[x]]:
+                    yield {'record': 'finding', 'file': name, 'finding': 'property_mismatch',
+                           'type': 'property_without_parameter', 'name': prop, 'instance': res.name}
+
+    def env_findings(self, env):
+        ''' Yields findings of environment file as dictionaries '''
+        name = os.path.relpath(env.path, self.init_dir)
+
+        for par in [x for x in env.params if not env.params[x]]:
+            yield {'record': 'finding', 'file': name, 'finding': 'unused_parameter',
+                   'type': 'parameter_without_match', 'name': par}
+
+        if self.print_unused:
+            for par in [x for x in env.params_default if not env.params_default[x]]:
+                yield {'record': 'finding', 'file': name, 'finding': 'unused_parameter',
+                       'type': 'parameter_default_without_match', 'name': par}
+
+    @staticmethod
+    def format_finding(finding):
+        ''' Returns human readable message of finding '''
+        kind = finding['finding']
+        if kind == 'invalid_reference':
+            if finding['type'] == 'attribute':
+                return ('Instance ' + finding['name'] + ' referred by get_attr in ' +
+                        finding['instance'] + ' is not declared.')
+            return (finding['type'].capitalize() + ' ' + finding['name'] + ' referred in ' +
+                    finding['instance'] + ' is not declared.')
+        elif kind == 'property_mismatch':
+            if finding['type'] == 'parameter_without_property':
+                return ('Parameter ' + finding['name'] + ' has no corresponding default or property in ' +
+                        finding['instance'] + ' in ' + finding['parent'] + '.')
+            return ('Property ' + finding['name'] + ' in ' + finding['instance'] +
+                    ' has no corresponding parameter.')
+        elif kind == 'unused_resource':
+            return 'Resource ' + finding['name'] + ' has no reference.'
+        elif finding['type'] == 'parameter_without_match':
+            return 'Parameter ' + finding['name'] + ' without match in root template.'
+        elif finding['type'] == 'parameter_default_without_match':
+            return 'Parameter default ' + finding['name'] + ' without match.'
+        return 'Parameter ' + finding['name'] + ' is not used.'
+
+    def emit(self, record):
+        ''' Writes record to output, adds name of batch job '''
+        if self.job is not None:
+            record['job'] = self.job
+        self.output.write(record)
+
+        if record['record'] == 'file':
+            self.files += 1
+        elif record['record'] == 'finding':
+            self.findings += 1
+
+    def report_file(self, node):
+        ''' Emits HOT file and its findings known once the file is validated '''
+
+        # Files in subtrees of environments are mapped
+        root = node
+        while isinstance(root.parent, self.YAML_Hotfile):
+            root = root.parent
+
+        self.emit({'record': 'file', 'file': os.path.relpath(node.abs_path, self.init_dir),
+                   'role': 'template' if root.parent is None else 'mapping',
+                   'parent': (os.path.relpath(node.parent.path, self.init_dir)
+                              if node.parent is not None else None)})
+        for finding in self.hot_findings(node, self.REFERENCES):
+            self.emit(finding)
+
+    def collect_findings(self):
+        ''' Returns all findings of validated files as (file, message) tuples '''
+        findings = [x for env in self.environments for x in self.env_findings(env)]
+        for node in self.templates + self.mappings:
+            findings.extend(self.hot_findings(node, self.REFERENCES))
+            findings.extend(self.hot_findings(node, self.PROPERTIES))
+        return [(x['file'], self.format_finding(x)) for x in findings]
+
+    def watched_files(self):
+        ''' Returns absolute path : (mtime, size) of all environments and HOT files '''
+        files = {}
+        paths = ([env.path for env in self.environments] +
+                 [node.abs_path for node in self.templates + self.mappings
+                  if node.abs_path is not None])
+        for path in paths:
+            try:
+                stat = os.stat(path)
+                files[path] = (stat.st_mtime, stat.st_size)
+            except (IOError, OSError):
+                files[path] = None
+        return files
+
+    def check_changed(self, changed):
+        ''' Returns error message if a changed file cannot be parsed or is not a HOT file
+            or environment, None if all of them can be validated.
+            changed - absolute paths of changed files
+        '''
+        for path in sorted(changed):
+            name = os.path.relpath(path, self.init_dir)
+            try:
+                structure = self.cache.load(path)
+            except (IOError, OSError) as e:
+                return name + ' could not be opened: ' + str(e)
+            except yaml.YAMLError as e:
+                return str(e)
+
+            if not isinstance(structure, dict):
+                return name + ' is not a mapping.'
+            for section in ['parameters', 'resources', 'outputs', 'resource_registry',
+                            'parameter_defaults']:
+                if section in structure and not isinstance(structure[section], dict):
+                    return 'Section ' + section + ' of ' + name + ' is not a mapping.'
+            for resource, resource_struct in six.iteritems(structure.get('resources', {})):
+                if not isinstance(resource_struct, dict) or 'type' not in resource_struct:
+                    return 'Resource ' + str(resource) + ' in ' + name + ' has no type.'
+        return None
+
+    def watch(self, interval):
+        ''' Polls validated files, validates changed ones again and prints changes in findings.
+            interval - seconds between checks of files
+        '''
+        findings = collections.Counter(self.collect_findings())
+        files = self.watched_files()
+        rebuild = False
+        print('Watching ' + str(len(files)) + ' files for changes, press Ctrl+C to stop.')
+
+        try:
+            while True:
+                time.sleep(interval)
+                current = self.watched_files()
+                changed = set(x for x in current if current[x] != files.get(x))
+                if not changed:
+                    continue
+
+                start = time.time()
+                names = ', '.join(sorted(os.path.relpath(x, self.init_dir) for x in changed))
+                error = self.check_changed(changed)
+                if error is not None:
+                    # Invalid file, validate everything once the file is fixed
+                    print('Changed: ' + names + ' could not be validated: ' + error, file=sys.stderr)
+                    rebuild = True
+                    files = current
+                    continue
+
+                try:
+                    if rebuild or [True for x in self.environments if x.path in changed]:
+                        # Environments change mappings, everything is loaded again
+                        self.__init__(self.arguments, self.cache)
+                        self.run(self.arguments['jobs'])
+                    else:
+                        self.revalidate(changed)
+                    rebuild = False
+                except SystemExit:
+                    # Missing nested file (already reported), validate everything once it exists
+                    rebuild = True
+                    files = current
+                    continue
+
+                new_findings = collections.Counter(self.collect_findings())
+                elapsed = (time.time() - start) * 1000
+
+                print('')
+                print('Changed: ' + names + ' (validated in %.1f ms)' % elapsed)
+                for sign, delta in [('+ ', new_findings - findings), ('- ', findings - new_findings)]:
+                    for (name, msg) in sorted(delta.elements()):
+                        if self.pretty_format:
+                            colour = YAML_colours.RED if sign == '+ ' else YAML_colours.GREEN
+                            print(colour + sign + YAML_colours.DEFAULT + YAML_colours.BLUE + name +
+                                  YAML_colours.DEFAULT + ': ' + msg)
+                        else:
+                            print(sign + name + ': ' + msg)
+                if new_findings == findings:
+                    print('No change in findings.')
+
+                findings = new_findings
+                files = self.watched_files()
+        except KeyboardInterrupt:
+            pass
+
+    def validate_parallel(self, jobs, report=None):
+        ''' Validates root template and mapped files in a pool of processes.
+            Each of them is a root of an independent subtree, whole subtrees are validated
+            in workers and merged back in the same order as in the serial run.
+            jobs   - number of worker processes
+            report - called with every node once its subtree is validated
+        '''
+
+        # Roots of mapped subtrees (in order of the serial run), root template is the last task
+        roots = [hot for hot in reversed(self.mappings) if hot.parent in self.environments]
+        tasks = [(hot.path, os.path.join(self.init_dir, os.path.dirname(hot.parent.path)),
+                  self.cache.cache_dir) for hot in roots]
+        tasks.append((self.templates[0].path,
+                      os.path.join(self.init_dir, os.path.dirname(self.templates[0].path)),
+                      self.cache.cache_dir))
+
+        pool = multiprocessing.Pool(jobs)
+        results = []
+        try:
+            for nodes, stats in pool.imap(validate_subtree, tasks):
+                # Worker printed the error already
+                if nodes is None:
+                    sys.exit(stats)
+                results.append((nodes, stats))
+
+                # Roots of mapped subtrees belong to environments
+                if len(results) <= len(roots):
+                    nodes[-1].parent = roots[len(results) - 1].parent
+
+                # Report nodes in the same order as validate_file does
+                if report is not None:
+                    stack = [(nodes[-1], False)]
+                    while stack:
+                        node, done = stack.pop()
+                        if done:
+                            report(node)
+                        else:
+                            stack.append((node, True))
+                            stack.extend((x, False) for x in reversed(node.children))
+        finally:
+            pool.close()
+            pool.join()
+
+        for nodes, stats in results:
+            self.cache.hits += stats[0]
+            self.cache.misses += stats[1]
+            self.cache.disk_hits += stats[2]
+
+        # Replace roots of mapped subtrees, environments keep them as children
+        replaced = {}
+        descendants = []
+        for old, (nodes, stats) in reversed(list(zip(roots, results))):
+            replaced[id(old)] = nodes[-1]
+            descendants.extend(nodes[:-1])
+
+        for env in self.environments:
+            env.children = [replaced.get(id(x), x) for x in env.children]
+
+        self.mappings = descendants + [replaced[id(x)] for x in reversed(roots)]
+        self.templates = results[-1][0]
 
 
     def validate_env_params(self):
@@ -469,18 +1112,18 @@ class YAML_HotValidator:
         # Check parameters section
         for env in self.environments:
             for par in list(env.params.keys()):
-                if par in list(self.templates[-1].params.keys()):
+                if par in self.templates[-1].params:
                     env.params[par] = True
 
         # Check parameter_defaults section
         for env in self.environments:
             for par in list(env.params_default.keys()):
                 for hot in self.templates:
-                    if par in list(hot.params.keys()):
+                    if par in hot.params:
                         env.params_default[par] = True
                         break
                 for hot in self.mappings:
-                    if par in list(hot.params.keys()):
+                    if par in hot.params:
                         env.params_default[par] = True
                         break
 
@@ -496,9 +1139,36 @@ class YAML_HotValidator:
                 self.validate_properties(resource.child)
 
 
+    def print_records(self):
+        ''' Emits findings known once the whole tree is validated, environments and summary.
+            Files and their reference findings are emitted during validation.
+        '''
+        for node in self.templates + self.mappings:
+            for finding in self.hot_findings(node, self.PROPERTIES):
+                self.emit(finding)
+
+        for env in self.environments:
+            self.emit({'record': 'file', 'file': os.path.relpath(env.path, self.init_dir),
+                       'role': 'environment', 'parent': None})
+            for finding in self.env_findings(env):
+                self.emit(finding)
+
+        summary = {'record': 'summary', 'files': self.files, 'findings': self.findings,
+                   'status': 'FAILED' if self.findings else 'OK'}
+        if self.print_stats:
+            summary['cache'] = {'hits': self.cache.hits, 'misses': self.cache.misses,
+                                'disk_hits': self.cache.disk_hits}
+            summary['elapsed'] = time.time() - self.start_time
+        self.emit(summary)
+
     def print_output(self):
         ''' Prints results of validation for all files + additional info. '''
 
+        # Machine readable output
+        if self.output_format != 'text':
+            self.print_records()
+            return
+
         # Environments
         if self.environments:
             if self.pretty_format:
@@ -688,7 +1358,7 @@ class YAML_HotValidator:
                         print('Properties without corresponding parameter :')
 
                     for res in [x for x in node.resources if x.type.endswith('.yaml')]:
-                        for prop, value in res.properties.iteritems():
+                        for prop, value in six.iteritems(res.properties):
                             if value == False:
                                 if self.pretty_format:
                                     print('- ' + YAML_colours.YELLOW + prop + YAML_colours.DEFAULT +
@@ -731,6 +1401,92 @@ class YAML_HotValidator:
 
                 print('\n\n')
 
+        # Parse cache statistics (optional)
+        if self.print_stats:
+            stats = (str(self.cache.hits) + ' hits, ' + str(self.cache.misses) + ' misses, ' +
+                     str(self.cache.disk_hits) + ' loaded from cache directory')
+            elapsed = '%.3f s' % (time.time() - self.start_time)
+            if self.pretty_format:
+                print(YAML_colours.BOLD + 'Parse cache: ' + YAML_colours.DEFAULT + stats)
+                print(YAML_colours.BOLD + 'Elapsed: ' + YAML_colours.DEFAULT + elapsed)
+            else:
+                print('Parse cache: ' + stats)
+                print('Elapsed: ' + elapsed)
+
+
+def validate_subtree(task):
+    ''' Validates subtree of HOT files in a worker process of YAML_HotValidator.validate_parallel.
+        task - (path of the subtree root, directory of the path, cache directory)
+        Returns all nodes of the subtree with the root as the last one and cache statistics,
+        or None and exit code when the subtree could not be validated.
+    '''
+    path, curr_path, cache_dir = task
+    cache = YAML_HotValidator.YAML_Cache(cache_dir)
+
+    root = YAML_HotValidator.YAML_Hotfile(None, path)
+    nodes = [root]
+    try:
+        root.validate_file([], nodes, [], curr_path, cache)
+    except SystemExit as e:
+        return (None, e.code)
+
+    return (nodes, (cache.hits, cache.misses, cache.disk_hits))
+
+
+def run_batch(arguments):
+    ''' Validates all jobs of batch manifest in one process, parsed files and extracted
+        references are shared by all jobs.
+        arguments - dictionary with parsed arguments and their values
+    '''
+    try:
+        with open(arguments['batch'], 'rb') as fd:
+            manifest = load_yaml(fd.read())
+    except IOError:
+        print('File ' + arguments['batch'] + ' could not be opened.', file=sys.stderr)
+        sys.exit(1)
+
+    if (not isinstance(manifest, list) or
+        [True for job in manifest if not isinstance(job, dict) or 'file' not in job]):
+        print('Batch manifest ' + arguments['batch'] + ' must be a list of jobs with a file.', file=sys.stderr)
+        sys.exit(1)
+
+    # Paths in manifest are relative to its directory
+    base_dir = os.path.dirname(os.path.abspath(arguments['batch']))
+
+    cache = YAML_HotValidator.YAML_Cache(arguments['cache_dir'])
+    output = YAML_Output(arguments['format'])
+    status = 0
+
+    for index, job in enumerate(manifest):
+        job_arguments = dict(arguments)
+        job_arguments['job'] = str(job.get('name', index))
+        job_arguments['file'] = os.path.join(base_dir, job['file'])
+        job_arguments['environment'] = [os.path.join(base_dir, x)
+                                        for x in (job.get('environment') or [])]
+
+        if arguments['format'] == 'text':
+            if arguments['pretty_format']:
+                print(YAML_colours.ORANGE + YAML_colours.BOLD + YAML_colours.UNDERLINE + 'Job ' +
+                      job_arguments['job'] + YAML_colours.DEFAULT)
+            else:
+                print('Job ' + job_arguments['job'])
+            print('')
+
+        # A job with missing files does not stop the others
+        try:
+            validator = YAML_HotValidator(job_arguments, cache, output)
+            validator.run(arguments['jobs'])
+            validator.print_output()
+        except SystemExit as e:
+            status = e.code
+            if arguments['format'] == 'text':
+                print('Job ' + job_arguments['job'] + ' could not be validated.\n\n')
+            else:
+                output.write({'record': 'summary', 'job': job_arguments['job'], 'status': 'ERROR'})
+
+    output.close()
+    sys.exit(status)
+
 
 def main():
     
@@ -740,52 +1496,50 @@ def main():
                         help='When true, prints all unused resources/parameters.')
     parser.add_argument('-p', '--pretty-format', action='store_true',
                         help='When true, provides colourful output')
+    parser.add_argument('-s', '--stats', action='store_true',
+                        help='When true, prints parse cache statistics.')
+    parser.add_argument('-c', '--cache-dir', metavar='path/to/cache',
+                        help='Directory for parsed files reused between runs.')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of processes validating independent subtrees.')
+    parser.add_argument('-w', '--watch', action='store_true',
+                        help='When true, keeps validating changed files and prints changes in findings.')
+    parser.add_argument('-i', '--interval', type=float, default=0.5,
+                        help='Seconds between checks of changed files in watch mode.')
+    parser.add_argument('-o', '--format', choices=['text', 'json', 'jsonl'], default='text',
+                        help='Output format, json and jsonl stream a record per file and finding.')
     parser.add_argument('-e', '--environment', metavar='path/to/environment', nargs='+',
                         help='Environment files to be used.')
     parser.add_argument('-f', '--file', metavar='path/to/file',
                         help='HOT file to be used.')
+    parser.add_argument('-b', '--batch', metavar='path/to/manifest',
+                        help='YAML list of jobs (name, file, environment) validated in one process.')
 
     # Initialize validator
-    validator = YAML_HotValidator(vars(parser.parse_args()))
-
-    # Run validator
+    arguments = vars(parser.parse_args())
+    if arguments['watch'] and (arguments['format'] != 'text' or arguments['batch']):
+        parser.error('Watch mode supports only text format of a single root template.')
 
-    # Load environments to get mappings
-    validator.load_environments()
+    if arguments['batch']:
+        run_batch(arguments)
+    elif not arguments['file']:
+        parser.error('HOT file (-f) or batch manifest (-b) is required.')
 
-    # Validate HOTs in mappings
-    # All mappings are at the beginning, followed by children nodes
-    for hot in list(reversed(validator.mappings)):
-        if hot.parent in validator.environments:
-            hot.validate_file(validator.curr_nodes, validator.mappings,
-                              validator.environments, os.path.join(validator.init_dir,
-                              os.path.dirname(hot.parent.path)))
-        else:
-            break
+    validator = YAML_HotValidator(arguments)
 
-    # Validate HOTs: change to its directory, validate -f
-    validator.templates[0].validate_file(validator.curr_nodes, validator.templates,
-                                         validator.environments,
-                                         os.path.join(validator.init_dir,
-                                         os.path.dirname(validator.templates[0].path)))
-
-    # Also add mapped files as children once there is a full structure of files
-    validator.load_mappings()
-
-    # Check environment parameters against fully loaded HOT structure
-    validator.validate_env_params()
-
-    # Check properties x parameters
-    validator.validate_properties(validator.templates[-1])
-
-    for hot in list(reversed(validator.mappings)):
-        if hot.parent in validator.environments:
-            validator.validate_properties(hot)
+    # Run validator
+    validator.run(arguments['jobs'])
 
     # Print results
     validator.print_output()
+    validator.output.close()
+
+    # Keep validating changed files
+    if arguments['watch']:
+        validator.watch(arguments['interval'])
 
     sys.exit(0)
 
+
 if __name__ == '__main__':
     main()
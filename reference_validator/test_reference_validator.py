@@ -0,0 +1,336 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+import six
+
+import reference_validator
+
+# Root template with mapped and nested resources, every file has some findings
+FILES = {
+    'root.yaml': '''heat_template_version: 2015-04-30
+parameters:
+  Count: {type: number, default: 1}
+  Unused: {type: string}
+resources:
+  Controller:
+    type: OS::TripleO::Controller
+    properties:
+      Count: {get_param: Count}
+      Extra: value
+  Compute:
+    type: OS::TripleO::Compute
+    properties:
+      Count: {get_param: Missing}
+  Storage:
+    type: OS::TripleO::Storage
+  Ceph:
+    type: OS::TripleO::CephStorage
+  Nested:
+    type: nested/nested.yaml
+    properties:
+      Input: {get_resource: Controller}
+outputs:
+  out: {value: {get_attr: [Unknown, value]}}
+''',
+    'nested/nested.yaml': '''heat_template_version: 2015-04-30
+parameters:
+  Input: {type: string}
+  Required: {type: string}
+resources:
+  Config:
+    type: leaf.yaml
+    properties:
+      Value: {get_param: Input}
+''',
+    'nested/leaf.yaml': '''heat_template_version: 2015-04-30
+parameters:
+  Value: {type: string}
+resources:
+  Config: {type: OS::Heat::None}
+outputs:
+  result: {value: {get_attr: [Config, value]}}
+''',
+    'controller.yaml': '''heat_template_version: 2015-04-30
+parameters:
+  Count: {type: number}
+resources:
+  Role:
+    type: nested/leaf.yaml
+    properties:
+      Value: {get_param: Count}
+''',
+    'compute.yaml': '''heat_template_version: 2015-04-30
+parameters:
+  Count: {type: number}
+  Flavor: {type: string}
+resources:
+  Server: {type: OS::Heat::None}
+''',
+    'role.yaml': '''heat_template_version: 2015-04-30
+parameters:
+  Count: {type: number}
+resources:
+  Server:
+    type: OS::Heat::None
+    properties:
+      name: {get_resource: Missing}
+''',
+    'any.yaml': '''heat_template_version: 2015-04-30
+resources: {}
+''',
+    'env.yaml': '''resource_registry:
+  OS::TripleO::*: any.yaml
+  OS::TripleO::C*: role.yaml
+  OS::TripleO::Controller: controller.yaml
+  resources:
+    Compute:
+      OS::TripleO::Compute: compute.yaml
+parameters:
+  Count: 2
+  NoMatch: x
+parameter_defaults:
+  Flavor: baremetal
+  Unknown: x
+''',
+    'batch.yaml': '''- name: full
+  file: root.yaml
+  environment: [env.yaml]
+- name: plain
+  file: nested/nested.yaml
+- file: controller.yaml
+  environment: [env.yaml]
+''',
+}
+
+
+class ValidatorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+        # Files are reported relative to the working directory
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.tmp_dir)
+
+        for name, content in FILES.items():
+            self.write(name, content)
+
+    def write(self, name, content):
+        if os.path.dirname(name) and not os.path.isdir(os.path.dirname(name)):
+            os.makedirs(os.path.dirname(name))
+        with open(name, 'w') as fd:
+            fd.write(content)
+
+    def arguments(self, **kwargs):
+        arguments = {'file': 'root.yaml', 'environment': ['env.yaml'], 'unused': True,
+                     'pretty_format': False, 'stats': False, 'cache_dir': None, 'jobs': 1,
+                     'watch': False, 'interval': 0, 'format': 'jsonl', 'batch': None}
+        arguments.update(kwargs)
+        return arguments
+
+    def capture(self, func, *args):
+        ''' Returns standard output of func '''
+        stdout = sys.stdout
+        sys.stdout = six.StringIO()
+        try:
+            func(*args)
+            return sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+    def validate(self, cache=None, **kwargs):
+        ''' Returns validator after the run and its output '''
+        validator = reference_validator.YAML_HotValidator(self.arguments(**kwargs), cache)
+
+        def run():
+            validator.run(validator.arguments['jobs'])
+            validator.print_output()
+            validator.output.close()
+
+        return validator, self.capture(run)
+
+
+class TestValidator(ValidatorTestCase):
+
+    def test_findings(self):
+        validator, output = self.validate()
+        findings = validator.collect_findings()
+        self.assertIn(('root.yaml', 'Parameter Missing referred in Compute is not declared.'),
+                      findings)
+        self.assertIn(('nested/nested.yaml', 'Parameter Required has no corresponding default '
+                       'or property in Nested in root.yaml.'), findings)
+        self.assertIn(('env.yaml', 'Parameter NoMatch without match in root template.'),
+                      findings)
+        self.assertEqual({'record': 'summary', 'files': 9, 'findings': len(findings),
+                          'status': 'FAILED'}, json.loads(output.splitlines()[-1]))
+
+    def test_file_parsed_once(self):
+        validator, output = self.validate()
+        # leaf.yaml is nested twice, other files once
+        self.assertEqual(len(FILES) - 1, validator.cache.misses)
+        self.assertEqual(1, validator.cache.hits)
+
+    def test_parallel(self):
+        for output_format in ['jsonl', 'text']:
+            serial, serial_output = self.validate(format=output_format)
+            parallel, parallel_output = self.validate(format=output_format, jobs=2)
+            self.assertEqual(serial_output, parallel_output)
+            self.assertEqual(serial.collect_findings(), parallel.collect_findings())
+
+    def test_warm_cache(self):
+        cache_dir = os.path.join(self.tmp_dir, 'cache')
+        cold, cold_output = self.validate(cache_dir=cache_dir)
+        self.assertEqual(0, cold.cache.disk_hits)
+        self.assertEqual(len(FILES) - 1, len(os.listdir(cache_dir)))
+
+        warm, warm_output = self.validate(cache_dir=cache_dir)
+        self.assertEqual(cold.cache.misses, warm.cache.disk_hits)
+        self.assertEqual(cold_output, warm_output)
+
+        # Changed file is parsed again
+        self.write('any.yaml', FILES['any.yaml'] + 'outputs: {}\n')
+        changed, changed_output = self.validate(cache_dir=cache_dir)
+        self.assertEqual(warm.cache.disk_hits - 1, changed.cache.disk_hits)
+        self.assertEqual(cold_output, changed_output)
+
+    def test_batch(self):
+        status = []
+
+        def run():
+            try:
+                reference_validator.run_batch(self.arguments(batch='batch.yaml', file=None,
+                                                             environment=None))
+            except SystemExit as e:
+                status.append(e.code)
+
+        batch_output = self.capture(run)
+        self.assertEqual([0], status)
+
+        jobs = [('full', 'root.yaml', ['env.yaml']),
+                ('plain', 'nested/nested.yaml', []),
+                ('2', 'controller.yaml', ['env.yaml'])]
+        outputs = [self.validate(job=name, file=path, environment=environments)[1]
+                   for name, path, environments in jobs]
+        self.assertEqual(''.join(outputs), batch_output)
+
+
+class TestRegistry(ValidatorTestCase):
+
+    def mapped(self, validator):
+        return dict((x.name, x.child.path if x.child else None)
+                    for x in validator.templates[-1].resources)
+
+    def test_specific_mapping_wins(self):
+        validator, output = self.validate()
+        self.assertEqual({'Controller': 'controller.yaml', 'Compute': 'compute.yaml',
+                          'Storage': 'any.yaml', 'Ceph': 'role.yaml',
+                          'Nested': 'nested/nested.yaml'}, self.mapped(validator))
+
+    def test_later_wildcard(self):
+        self.write('override.yaml', 'resource_registry:\n  OS::TripleO::*: any.yaml\n')
+        validator, output = self.validate(environment=['env.yaml', 'override.yaml'])
+        mapped = self.mapped(validator)
+        self.assertEqual('controller.yaml', mapped['Controller'])
+        self.assertEqual('compute.yaml', mapped['Compute'])
+        # Wildcards of later environments are matched first
+        self.assertEqual('any.yaml', mapped['Ceph'])
+
+    def test_later_environment_wins(self):
+        self.write('override.yaml', 'resource_registry:\n  OS::TripleO::Controller: role.yaml\n')
+        validator, output = self.validate(environment=['env.yaml', 'override.yaml'])
+        self.assertEqual('role.yaml', self.mapped(validator)['Controller'])
+
+    def test_several_wildcards(self):
+        self.write('root.yaml', FILES['root.yaml'].replace(
+            'outputs:', '  Network:\n    type: OS::TripleO::Controller::Net::Config\noutputs:'))
+        self.write('override.yaml', 'resource_registry:\n  OS::TripleO::*::Net::*: compute.yaml\n'
+                                    '  OS::*::*::*: role.yaml\n')
+        validator, output = self.validate(environment=['env.yaml', 'override.yaml'])
+        mapped = self.mapped(validator)
+        self.assertEqual('compute.yaml', mapped['Network'])
+        self.assertEqual('controller.yaml', mapped['Controller'])
+        self.assertEqual('any.yaml', mapped['Storage'])
+
+    def test_unmapped(self):
+        validator, output = self.validate(environment=None)
+        self.assertEqual({'Controller': None, 'Compute': None, 'Storage': None, 'Ceph': None,
+                          'Nested': 'nested/nested.yaml'}, self.mapped(validator))
+
+
+class TestWatch(ValidatorTestCase):
+
+    def watch(self, changes):
+        ''' Runs watch mode, each check of files follows a change from changes,
+            returns standard output and error of the watch mode
+        '''
+        validator, output = self.validate(format='text')
+        changes = list(changes)
+        mtime = [time.time()]
+
+        def sleep(interval):
+            if not changes:
+                raise KeyboardInterrupt
+            name, content = changes.pop(0)
+            self.write(name, content)
+            # Writes within the resolution of mtime are detected too
+            mtime[0] += 1
+            os.utime(name, (mtime[0], mtime[0]))
+
+        self.addCleanup(setattr, time, 'sleep', time.sleep)
+        time.sleep = sleep
+        self.addCleanup(setattr, sys, 'stderr', sys.stderr)
+        sys.stderr = six.StringIO()
+
+        output = self.capture(validator.watch, 0)
+        return output.splitlines(), sys.stderr.getvalue().splitlines()
+
+    def test_changed_findings(self):
+        image = FILES['compute.yaml'].replace('resources:', '  Image: {type: string, default: cirros}\nresources:')
+        output, errors = self.watch([('compute.yaml', image)])
+        self.assertEqual([], errors)
+        self.assertEqual('', output[1])
+        self.assertTrue(output[2].startswith('Changed: compute.yaml (validated in '))
+        self.assertEqual(['+ compute.yaml: Parameter Image is not used.'], output[3:])
+
+    def test_invalid_file(self):
+        valid = FILES['compute.yaml'].replace('Flavor', 'Image')
+        output, errors = self.watch([('compute.yaml', 'resources: [\n'),
+                                     ('compute.yaml', ''),
+                                     ('compute.yaml', 'resources: []\n'),
+                                     ('compute.yaml', valid)])
+
+        # Parse error, empty file and invalid section are reported, watch mode keeps running
+        errors = [x for x in errors if x.startswith('Changed: ')]
+        self.assertEqual(3, len(errors))
+        for error in errors:
+            self.assertTrue(error.startswith('Changed: compute.yaml could not be validated: '))
+        self.assertTrue(errors[1].endswith('compute.yaml is not a mapping.'))
+        self.assertTrue(errors[2].endswith('Section resources of compute.yaml is not a mapping.'))
+
+        # Findings are compared with the last valid version
+        self.assertTrue(output[2].startswith('Changed: compute.yaml (validated in '))
+        self.assertEqual(['+ compute.yaml: Parameter Image has no corresponding default or property '
+                          'in Compute in root.yaml.',
+                          '+ compute.yaml: Parameter Image is not used.',
+                          '+ env.yaml: Parameter default Flavor without match.',
+                          '- compute.yaml: Parameter Flavor is not used.'], output[3:])
+
+    def test_error_not_hidden(self):
+        def revalidate(changed):
+            raise TypeError('bug')
+
+        validator_class = reference_validator.YAML_HotValidator
+        self.addCleanup(setattr, validator_class, 'revalidate', validator_class.revalidate)
+        validator_class.revalidate = staticmethod(revalidate)
+        with self.assertRaises(TypeError):
+            self.watch([('compute.yaml', FILES['compute.yaml'] + 'outputs: {}\n')])
+
+
+if __name__ == '__main__':
+    unittest.main()